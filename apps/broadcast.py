@@ -0,0 +1,243 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable
+
+import asyncpg
+
+from apps.metrics import Counter, Gauge, Histogram
+from apps.serialization import dumps
+from apps.settings import settings
+
+
+Callback = Callable[[str], Awaitable[None]]
+
+logger = logging.getLogger(__name__)
+
+room_subscribers = Gauge("broadcast_room_subscribers", "Local subscribers of a broadcast room, one per socket", ("room",))
+broadcast_published = Counter("broadcast_published_total", "Messages published to rooms")
+broadcast_publish = Histogram("broadcast_publish_seconds", "Time to hand a message to the broadcast backend")
+broadcast_fanout = Histogram("broadcast_fanout_seconds", "Time to deliver a message to all local subscribers of a room")
+broadcast_errors = Counter("broadcast_errors_total", "Messages the broadcast reader failed to deliver")
+broadcast_backend_queue = Gauge("broadcast_backend_queue_depth", "Notifications received but not yet dispatched")
+broadcast_reconnects = Counter("broadcast_reconnects_total", "Times the LISTEN connection was lost and opened again")
+
+
+# Доставка внутри одного процесса (один uvicorn worker)
+class MemoryBackend:
+    async def connect(self, on_message, on_reconnect):
+        self._on_message = on_message
+
+    async def disconnect(self):
+        self._on_message = None
+
+    async def publish(self, room: str, data: str):
+        await self._on_message(room, data)
+
+
+# Кадр длиннее лимита NOTIFY режется на части по границам символов UTF-8
+def split_payload(data: str, limit: int) -> list[str]:
+    raw = data.encode()
+    parts = []
+    while raw:
+        cut = min(limit, len(raw))
+        while cut < len(raw) and raw[cut] & 0xC0 == 0x80:
+            cut -= 1
+        parts.append(raw[:cut].decode())
+        raw = raw[cut:]
+    return parts
+
+
+# Доставка между процессами и серверами через Postgres LISTEN/NOTIFY:
+# каждый worker слушает общий канал и получает сообщения всех остальных
+class PostgresBackend:
+    CHANNEL = "chat_events"
+    # Postgres ограничивает payload NOTIFY 8000 байтами
+    MAX_PAYLOAD = 7999
+    # Заголовок части: комната, номер и число частей
+    PART_HEADER = 300
+
+    def __init__(self, dsn: str):
+        self._dsn = dsn
+        self._listen_conn = None
+        self._pool = None
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._reader = None
+        self._watcher = None
+        self._lost = asyncio.Event()
+        self._parts: list[str] = []
+
+    async def connect(self, on_message, on_reconnect):
+        self._on_message = on_message
+        self._on_reconnect = on_reconnect
+        self._pool = await asyncpg.create_pool(self._dsn, min_size=1, max_size=settings.BROADCAST_POOL_SIZE)
+        broadcast_backend_queue.set_function(self._queue.qsize)
+        await self._listen()
+        self._reader = asyncio.create_task(self._read())
+        self._watcher = asyncio.create_task(self._watch())
+
+    async def disconnect(self):
+        for task in (self._watcher, self._reader):
+            if task:
+                task.cancel()
+        if self._listen_conn:
+            self._listen_conn.remove_termination_listener(self._terminated)
+            await self._listen_conn.close()
+        if self._pool:
+            await self._pool.close()
+
+    # Кадр, не влезающий в один NOTIFY, уходит частями "room\n<i>/<n>\n<часть>"
+    # в одной транзакции: уведомления транзакции доставляются подряд и по
+    # порядку, поэтому читатель просто собирает их. Целый кадр всегда
+    # начинается с "{", по этому части и отличаются
+    async def publish(self, room: str, data: str):
+        payload = f"{room}\n{data}"
+        if len(payload.encode()) <= self.MAX_PAYLOAD:
+            await self._pool.execute("SELECT pg_notify($1, $2)", self.CHANNEL, payload)
+            return
+
+        parts = split_payload(data, self.MAX_PAYLOAD - self.PART_HEADER)
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                for i, part in enumerate(parts):
+                    payload = f"{room}\n{i}/{len(parts)}\n{part}"
+                    await conn.execute("SELECT pg_notify($1, $2)", self.CHANNEL, payload)
+
+    def _listener(self, connection, pid, channel, payload):
+        self._queue.put_nowait(payload)
+
+    def _terminated(self, connection):
+        self._lost.set()
+
+    async def _listen(self):
+        conn = await asyncpg.connect(self._dsn)
+        await conn.add_listener(self.CHANNEL, self._listener)
+        conn.add_termination_listener(self._terminated)
+        self._listen_conn = conn
+
+    # Если соединение LISTEN оборвалось или перестало отвечать, оно
+    # открывается заново; уведомления, пришедшие за это время, потеряны,
+    # о чём сообщается через on_reconnect
+    async def _watch(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._lost.wait(), settings.BROADCAST_CHECK_INTERVAL)
+            except asyncio.TimeoutError:
+                if await self._alive():
+                    continue
+
+            logger.warning("Broadcast LISTEN connection lost, reconnecting")
+            self._listen_conn.remove_termination_listener(self._terminated)
+            self._listen_conn.terminate()
+            self._lost.clear()
+            delay = 0.5
+            while True:
+                try:
+                    await self._listen()
+                    break
+                except Exception as e:
+                    logger.warning("Broadcast reconnect failed: %r", e)
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, settings.BROADCAST_CHECK_INTERVAL)
+            broadcast_reconnects.inc()
+            self._on_reconnect()
+
+    async def _alive(self) -> bool:
+        try:
+            await asyncio.wait_for(self._listen_conn.execute("SELECT 1"), settings.BROADCAST_CHECK_INTERVAL)
+            return True
+        except Exception:
+            return False
+
+    async def _read(self):
+        # Одна задача-читатель сохраняет порядок сообщений
+        while True:
+            payload = await self._queue.get()
+            room, _, data = payload.partition("\n")
+            if not data.startswith("{"):
+                position, _, part = data.partition("\n")
+                index, _, count = position.partition("/")
+                if index == "0":
+                    self._parts = []
+                self._parts.append(part)
+                if int(index) + 1 < int(count):
+                    continue
+                data = "".join(self._parts)
+                self._parts = []
+            try:
+                await self._on_message(room, data)
+            except Exception:
+                broadcast_errors.inc()
+                logger.exception("Broadcast dispatch failed for %s", room)
+
+
+class Broadcast:
+    def __init__(self, backend):
+        self._backend = backend
+        self._subscribers: dict[str, set[Callback]] = {}
+        self._listeners: list = []
+        self._reconnect_listeners: list = []
+
+    async def connect(self):
+        await self._backend.connect(self._dispatch, self._reconnected)
+
+    async def disconnect(self):
+        await self._backend.disconnect()
+
+    def subscribe(self, room: str, callback: Callback):
+        subscribers = self._subscribers.setdefault(room, set())
+        subscribers.add(callback)
+        room_subscribers.set(len(subscribers), room=room)
+
+    def unsubscribe(self, room: str, callback: Callback):
+        subscribers = self._subscribers.get(room)
+        if subscribers is None:
+            return
+        subscribers.discard(callback)
+        if not subscribers:
+            del self._subscribers[room]
+            room_subscribers.remove(room=room)
+        else:
+            room_subscribers.set(len(subscribers), room=room)
+
+    # Слушатель получает все кадры, пришедшие в этот worker, в том числе
+    # для комнат без подписчиков; вызывается синхронно до рассылки
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    # Вызывается после восстановления связи с backend'ом: кадры, отправленные
+    # во время обрыва, до этого worker'а не дошли
+    def add_reconnect_listener(self, callback):
+        self._reconnect_listeners.append(callback)
+
+    def has_subscribers(self, room: str) -> bool:
+        return room in self._subscribers
+
+    async def publish(self, room: str, message: dict):
+        started = time.perf_counter()
+        await self._backend.publish(room, dumps(message))
+        broadcast_publish.observe(time.perf_counter() - started)
+        broadcast_published.inc()
+
+    def _reconnected(self):
+        for callback in self._reconnect_listeners:
+            callback()
+
+    async def _dispatch(self, room: str, data: str):
+        started = time.perf_counter()
+        for listener in self._listeners:
+            listener(room, data)
+        for callback in list(self._subscribers.get(room, ())):
+            await callback(data)
+        broadcast_fanout.observe(time.perf_counter() - started)
+
+
+def get_backend():
+    if settings.BROADCAST_BACKEND == "postgres":
+        return PostgresBackend(settings.DATABASE_DSN)
+    if settings.BROADCAST_BACKEND == "memory":
+        return MemoryBackend()
+    raise ValueError(f"Unknown broadcast backend: {settings.BROADCAST_BACKEND}")
+
+
+broadcast = Broadcast(get_backend())
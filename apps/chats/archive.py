@@ -0,0 +1,245 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import shutil
+import time
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import insert, select, text
+
+from apps.cache import TTLCache
+from apps.database import db_session, engine
+from apps.settings import settings
+from apps.users.models import MessageArchive
+from apps.chats.partitions import ensure_partitions, list_partitions
+from apps.chats.sync import prune_changes
+
+
+logger = logging.getLogger(__name__)
+
+# Строка архива с теми же полями, что и строки MESSAGE_COLUMNS; в архивах,
+# выгруженных до появления seq, номера нет
+ArchivedMessage = namedtuple(
+    "ArchivedMessage", ["id", "chat_id", "sender_id", "text", "timestamp", "seq"], defaults=(None,)
+)
+
+# Ключ pg_advisory_lock: обслуживание секций выполняет один worker за раз
+MAINTENANCE_LOCK = 7246013
+ARCHIVE_CACHE_TTL = 60
+ARCHIVE_FILE_TTL = 600
+
+
+# Холодная секция выгружается в MESSAGE_ARCHIVE_DIR/<секция>/<chat_id>.jsonl.gz,
+# сообщения каждого чата по возрастанию (timestamp, id), после чего секция
+# отсоединяется и удаляется. Список выгруженных секций и их чатов хранится
+# в message_archives, по нему история дочитывается из файлов
+def chat_archive_path(partition: str, chat_id: int) -> str:
+    return os.path.join(settings.MESSAGE_ARCHIVE_DIR, partition, f"{chat_id}.jsonl.gz")
+
+
+def _write_chat(directory: str, chat_id: int, lines: list[str]):
+    with gzip.open(os.path.join(directory, f"{chat_id}.jsonl.gz"), "wt", encoding="utf-8") as f:
+        f.writelines(lines)
+
+
+def _read_chat(partition: str, chat_id: int) -> list[ArchivedMessage]:
+    messages = []
+    with gzip.open(chat_archive_path(partition, chat_id), "rt", encoding="utf-8") as f:
+        for line in f:
+            row = json.loads(line)
+            row["timestamp"] = datetime.fromisoformat(row["timestamp"])
+            messages.append(ArchivedMessage(**row))
+    return messages
+
+
+async def archive_partition(conn, partition: str, range_start: datetime, range_end: datetime) -> int:
+    directory = os.path.join(settings.MESSAGE_ARCHIVE_DIR, partition)
+    tmp_directory = directory + ".tmp"
+    await asyncio.to_thread(shutil.rmtree, tmp_directory, True)
+    await asyncio.to_thread(os.makedirs, tmp_directory)
+
+    rows = 0
+    chat_ids = []
+    chat_id, lines = None, []
+    result = await conn.stream(text(
+        f"SELECT id, chat_id, sender_id, text, timestamp, seq FROM {partition} ORDER BY chat_id, timestamp, id"
+    ))
+    async for row in result:
+        if row.chat_id != chat_id:
+            if lines:
+                await asyncio.to_thread(_write_chat, tmp_directory, chat_id, lines)
+            chat_id, lines = row.chat_id, []
+            chat_ids.append(chat_id)
+        lines.append(json.dumps({
+            "id": row.id,
+            "chat_id": row.chat_id,
+            "sender_id": row.sender_id,
+            "text": row.text,
+            "timestamp": row.timestamp.isoformat(),
+            "seq": row.seq
+        }, ensure_ascii=False) + "\n")
+        rows += 1
+    if lines:
+        await asyncio.to_thread(_write_chat, tmp_directory, chat_id, lines)
+
+    # Секция удаляется только после того, как архив полностью записан
+    await asyncio.to_thread(shutil.rmtree, directory, True)
+    await asyncio.to_thread(os.rename, tmp_directory, directory)
+
+    await conn.execute(insert(MessageArchive).values(
+        partition=partition,
+        range_start=range_start,
+        range_end=range_end,
+        chat_ids=chat_ids,
+        rows=rows
+    ))
+    await conn.execute(text(f"ALTER TABLE messages DETACH PARTITION {partition}"))
+    # Курсор выгрузки закрывается только вместе с транзакцией
+    await conn.commit()
+    await conn.execute(text(f"DROP TABLE {partition}"))
+    await conn.commit()
+    return rows
+
+
+# archive=False - только секции на будущие месяцы, без выгрузки и очистки журнала
+async def run_maintenance(archive: bool = True):
+    async with engine.connect() as conn:
+        locked = await conn.scalar(text("SELECT pg_try_advisory_lock(:key)"), {"key": MAINTENANCE_LOCK})
+        await conn.commit()
+        if not locked:
+            return
+        try:
+            await ensure_partitions(conn, settings.MESSAGE_PARTITIONS_AHEAD)
+            if not archive:
+                return
+            if settings.MESSAGE_RETENTION_DAYS > 0:
+                cutoff = datetime.utcnow() - timedelta(days=settings.MESSAGE_RETENTION_DAYS)
+                for partition, range_start, range_end in await list_partitions(conn):
+                    if range_end <= cutoff:
+                        rows = await archive_partition(conn, partition, range_start, range_end)
+                        logger.info("Archived %s: %s messages", partition, rows)
+                        reset_archives()
+            if settings.SYNC_RETENTION_DAYS > 0:
+                cutoff = datetime.utcnow() - timedelta(days=settings.SYNC_RETENTION_DAYS)
+                async with db_session() as db:
+                    rows = await prune_changes(db, cutoff)
+                if rows:
+                    logger.info("Pruned %s change log entries", rows)
+        finally:
+            await conn.rollback()
+            await conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": MAINTENANCE_LOCK})
+            await conn.commit()
+
+
+# Периодическое обслуживание: новые секции заранее и выгрузка старых
+class ArchiveJob:
+    def __init__(self):
+        self._task = None
+
+    # До запуска приложения создаются только секции: выгрузка старых может
+    # идти часами, поэтому она сразу уходит в фоновую задачу. Сбой при старте
+    # не должен мешать запуску приложения
+    async def start(self):
+        try:
+            await run_maintenance(archive=False)
+        except Exception:
+            logger.exception("Message partition maintenance failed")
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        while True:
+            try:
+                await run_maintenance()
+            except Exception:
+                logger.exception("Message partition maintenance failed")
+            await asyncio.sleep(settings.MESSAGE_MAINTENANCE_INTERVAL)
+
+
+archiver = ArchiveJob()
+
+
+# Список архивов держится в памяти, чтобы чаты без архива не обращались ни
+# к базе, ни к диску
+_archives: list = []
+_archives_loaded_at = 0.0
+
+
+def reset_archives():
+    global _archives_loaded_at
+    _archives_loaded_at = 0.0
+
+
+async def get_archives() -> list:
+    global _archives, _archives_loaded_at
+    if not _archives_loaded_at or time.monotonic() - _archives_loaded_at > ARCHIVE_CACHE_TTL:
+        async with db_session() as db:
+            result = await db.execute(
+                select(MessageArchive.partition, MessageArchive.range_start, MessageArchive.range_end, MessageArchive.chat_ids)
+                .order_by(MessageArchive.range_start)
+            )
+            _archives = [(partition, start, end, frozenset(chat_ids)) for partition, start, end, chat_ids in result]
+        _archives_loaded_at = time.monotonic()
+    return _archives
+
+
+# Файлы архива не меняются, поэтому разобранный файл чата держится в памяти
+# вместе с ключами (timestamp, id): страница находится бинарным поиском, и
+# листание месяца не распаковывает файл заново на каждой странице
+_chat_files = TTLCache(maxsize=settings.ARCHIVE_CACHE_FILES, ttl=ARCHIVE_FILE_TTL)
+
+
+async def _load_chat(partition: str, chat_id: int) -> tuple[list, list[ArchivedMessage]]:
+    cached = _chat_files.get((partition, chat_id))
+    if cached is None:
+        rows = await asyncio.to_thread(_read_chat, partition, chat_id)
+        cached = ([(r.timestamp, r.id) for r in rows], rows)
+        _chat_files.set((partition, chat_id), cached)
+    return cached
+
+
+# Архивные сообщения чата строго раньше before, новые первыми
+async def archived_before(chat_id: int, limit: int, before: tuple[datetime, int] = None) -> list:
+    messages = []
+    for partition, range_start, range_end, chat_ids in reversed(await get_archives()):
+        if len(messages) >= limit:
+            break
+        if chat_id not in chat_ids or (before is not None and range_start > before[0]):
+            continue
+        keys, rows = await _load_chat(partition, chat_id)
+        end = len(rows) if before is None else bisect_left(keys, before)
+        messages.extend(reversed(rows[max(end - (limit - len(messages)), 0):end]))
+    return messages
+
+
+# Архивные сообщения чата строго позже after, старые первыми
+async def archived_after(chat_id: int, limit: int, after: tuple[datetime, int] = None) -> list:
+    messages = []
+    for partition, range_start, range_end, chat_ids in await get_archives():
+        if len(messages) >= limit:
+            break
+        if chat_id not in chat_ids or (after is not None and range_end <= after[0]):
+            continue
+        keys, rows = await _load_chat(partition, chat_id)
+        start = 0 if after is None else bisect_right(keys, after)
+        messages.extend(rows[start:start + limit - len(messages)])
+    return messages
+
+if __name__ == "__main__":
+    async def main():
+        await run_maintenance()
+        await engine.dispose()
+
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
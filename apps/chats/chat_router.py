@@ -1,13 +1,28 @@
+import time
 from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
 from apps.database import get_db_session
 from apps.users.models import *
 from apps.chats.schema import *
 from apps.users.user_router import get_current_user
 from sqlalchemy.orm import joinedload
-
-router = APIRouter()
+from apps.chats.membership import (
+    is_chat_member, is_group_member, invalidate_chat, invalidate_group, find_missing_users,
+    add_chat_members, remove_chat_members, add_group_members, remove_group_members
+)
+from apps.settings import settings
+from apps.chats.read_state import unread_counts_query
+from apps.chats.history import load_history_before, load_history_after, encode_cursor, decode_cursor, serialize_message
+from apps.chats.inbox import inbox_query, serialize_inbox_row, encode_inbox_cursor, decode_inbox_cursor
+from apps.chats.search import search_messages, encode_search_cursor, decode_search_cursor
+from apps.chats.sync import SYNC_HORIZON, sync_query, serialize_change, encode_sync_token, decode_sync_token
+from apps.serialization import FastJSONResponse
+from apps.rate_limit import rate_limit_api
+
+router = APIRouter(dependencies=[Depends(rate_limit_api)])
 
 @router.post("/chats/create", response_model=ChatResponse)
 async def create_chat(
@@ -15,20 +30,79 @@ async def create_chat(
     current_user: Users = Depends(get_current_user),
     db: AsyncSession = Depends(get_db_session)
 ):
+    await check_users_exist(db, chat_data.user_ids)
+
     chat = Chats(title=chat_data.title, chats_type=chat_data.chats_type)
     db.add(chat)
-    await db.flush()  
+    try:
+        await db.flush()
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(status_code=409, detail="Chat title already taken")
+
+    await add_chat_members(db, chat.id, [current_user.id] + chat_data.user_ids)
+    await db.commit()
+    await invalidate_chat(chat.id)
+    return chat
 
-    chat_user = ChatUser(chat_id=chat.id, user_id=current_user.id)
-    db.add(chat_user)
 
-    for uid in chat_data.user_ids:
-        db.add(ChatUser(chat_id=chat.id, user_id=uid))
+# Проверка списка пользователей для массовых операций одним запросом
+async def check_users_exist(db: AsyncSession, user_ids: list[int]):
+    if len(user_ids) > settings.MEMBERSHIP_BULK_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {settings.MEMBERSHIP_BULK_MAX} users per request")
+    missing = await find_missing_users(db, user_ids)
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Users not found: {missing}")
 
-    await db.commit()
-    await db.refresh(chat)
+
+async def get_editable_chat(db: AsyncSession, chat_id: int, user_id: int) -> Chats:
+    result = await db.execute(select(Chats).where(Chats.id == chat_id))
+    chat = result.scalars().first()
+    if not chat:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    if not await is_chat_member(db, chat_id, user_id):
+        raise HTTPException(status_code=403, detail="You are not a participant of this chat")
+    # Личные чаты фиксированы, а участники группового чата меняются через группу
+    if chat.chats_type == ChatType.PRIVATE or chat.min_user_id is not None:
+        raise HTTPException(status_code=400, detail="Members of a private chat cannot be changed")
+    group = await db.execute(select(Groups.id).where(Groups.chat_id == chat_id))
+    if group.scalar():
+        raise HTTPException(status_code=400, detail="Use group membership endpoints for a group chat")
     return chat
 
+
+@router.post("/chats/{chat_id}/members")
+async def add_chat_users(
+    chat_id: int,
+    payload: BulkMembersSchema,
+    current_user: Users = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db_session)
+):
+    await get_editable_chat(db, chat_id, current_user.id)
+    await check_users_exist(db, payload.user_ids)
+
+    added = await add_chat_members(db, chat_id, payload.user_ids)
+    await db.commit()
+    await invalidate_chat(chat_id)
+    return {"detail": "Users added to chat", "user_ids": added}
+
+
+@router.post("/chats/{chat_id}/members/remove")
+async def remove_chat_users(
+    chat_id: int,
+    payload: BulkMembersSchema,
+    current_user: Users = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db_session)
+):
+    await get_editable_chat(db, chat_id, current_user.id)
+    if len(payload.user_ids) > settings.MEMBERSHIP_BULK_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {settings.MEMBERSHIP_BULK_MAX} users per request")
+
+    removed = await remove_chat_members(db, chat_id, payload.user_ids)
+    await db.commit()
+    await invalidate_chat(chat_id)
+    return {"detail": "Users removed from chat", "user_ids": removed}
+
 @router.get("/chats", response_model=list[ChatResponse])
 async def list_user_chats(
     current_user: Users = Depends(get_current_user),
@@ -40,6 +114,37 @@ async def list_user_chats(
 
 
 
+@router.get("/chats/unread", response_model=list[UnreadCountResponse])
+async def list_unread_counts(
+    current_user: Users = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db_session)
+):
+    result = await db.execute(unread_counts_query(current_user.id))
+    return result.all()
+
+
+# Список чатов для главного экрана: последние активные первыми
+@router.get("/chats/inbox", response_model=InboxPageResponse)
+async def list_inbox(
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None,
+    current_user: Users = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db_session)
+):
+    try:
+        before = decode_inbox_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    result = await db.execute(inbox_query(current_user.id, limit + 1, before=before))
+    chats = result.all()
+
+    has_more = len(chats) > limit
+    chats = chats[:limit]
+    next_cursor = encode_inbox_cursor(chats[-1]) if has_more else None
+    return FastJSONResponse({"chats": [serialize_inbox_row(c) for c in chats], "next_cursor": next_cursor})
+
+
 @router.post("/create_private_chat")
 async def create_private_chat(user1_id: int, user2_id: int,current_user: Users = Depends(get_current_user), db: AsyncSession = Depends(get_db_session)):
     if user1_id == user2_id:
@@ -51,106 +156,193 @@ async def create_private_chat(user1_id: int, user2_id: int,current_user: Users =
     if len(users_found) != 2:
         raise HTTPException(status_code=404, detail="One or both users not found")
 
-    chat_stmt = select(Chats).where(Chats.chats_type == ChatType.PRIVATE)
-    chat_result = await db.execute(chat_stmt)
-    private_chats = chat_result.scalars().all()
-
-    for chat in private_chats:
-        participant_stmt = select(ChatUser).where(ChatUser.chat_id == chat.id)
-        result = await db.execute(participant_stmt)
-        participants = [cu.user_id for cu in result.scalars().all()]
-        if set(participants) == set([user1_id, user2_id]):
-            return {"detail": "Chat already exists", "chat_id": chat.id}
-
-    new_chat = Chats(
-        title=f"Private Chat {user1_id}-{user2_id}",
-        chats_type=ChatType.PRIVATE
+    min_user_id, max_user_id = sorted((user1_id, user2_id))
+    pair_stmt = select(Chats.id).where(Chats.min_user_id == min_user_id, Chats.max_user_id == max_user_id)
+    result = await db.execute(pair_stmt)
+    chat_id = result.scalar()
+    if chat_id:
+        return {"detail": "Chat already exists", "chat_id": chat_id}
+
+    # Параллельный запрос мог успеть создать тот же чат - тогда вставка ничего не вернёт
+    chat_stmt = (
+        pg_insert(Chats)
+        .values(
+            title=f"Private Chat {min_user_id}-{max_user_id}",
+            chats_type=ChatType.PRIVATE,
+            min_user_id=min_user_id,
+            max_user_id=max_user_id
+        )
+        .on_conflict_do_nothing()
+        .returning(Chats.id)
     )
-    db.add(new_chat)
-    await db.commit()
-    await db.refresh(new_chat)
-
-    user_links = [
-        ChatUser(chat_id=new_chat.id, user_id=user1_id),
-        ChatUser(chat_id=new_chat.id, user_id=user2_id)
-    ]
-    db.add_all(user_links)
+    result = await db.execute(chat_stmt)
+    chat_id = result.scalar()
+    if not chat_id:
+        await db.rollback()
+        result = await db.execute(pair_stmt)
+        chat_id = result.scalar()
+        if not chat_id:
+            raise HTTPException(status_code=409, detail="Chat title already taken")
+        return {"detail": "Chat already exists", "chat_id": chat_id}
+
+    await add_chat_members(db, chat_id, [user1_id, user2_id])
     await db.commit()
+    await invalidate_chat(chat_id)
 
-    return {"detail": "Private chat created", "chat_id": new_chat.id}
+    return {"detail": "Private chat created", "chat_id": chat_id}
 
 
-@router.get("/history/{chat_id}", response_model=list[MessageResponse])
+@router.get("/history/{chat_id}", response_model=MessagePageResponse)
 async def get_chat_history(
     chat_id: int,
     limit: int = Query(20, ge=1, le=100),      
-    offset: int = Query(0, ge=0),               
+    before: Optional[str] = None,
+    after: Optional[str] = None,
     current_user: Users = Depends(get_current_user),
     db: AsyncSession = Depends(get_db_session)
 ):
-    chat_stmt = select(Chats).where(Chats.id == chat_id)
-    result = await db.execute(chat_stmt)
-    chat = result.scalars().first() 
-    if not chat:
-        raise HTTPException(status_code=404, detail="Chat not found")
+    if not await is_chat_member(db, chat_id, current_user.id):
+        chat_stmt = select(Chats.id).where(Chats.id == chat_id)
+        result = await db.execute(chat_stmt)
+        if not result.scalar():
+            raise HTTPException(status_code=404, detail="Chat not found")
+        raise HTTPException(status_code=403, detail="You are not a participant of this chat")
 
-    user_stmt = select(ChatUser).where(ChatUser.chat_id == chat_id, ChatUser.user_id == current_user.id)
-    result = await db.execute(user_stmt)
-    user_chat = result.scalars().first()
-    if not user_chat:
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after cursor")
+
+    try:
+        before = decode_cursor(before) if before else None
+        after = decode_cursor(after) if after else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    # before листает назад от курсора, иначе - вперёд от начала чата или от after
+    if before:
+        messages = await load_history_before(db, chat_id, limit + 1, before=before)
+    else:
+        messages = await load_history_after(db, chat_id, limit + 1, after=after)
+
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    next_cursor = encode_cursor(messages[-1]) if has_more else None
+    if before:
+        messages = messages[::-1]
+
+    # Строки сериализуются напрямую, минуя валидацию response_model
+    return FastJSONResponse({"messages": [serialize_message(m) for m in messages], "next_cursor": next_cursor})
+
+
+@router.get("/search", response_model=SearchPageResponse)
+async def search_chat_messages(
+    q: str = Query(..., min_length=1, max_length=200),
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None,
+    chat_id: Optional[int] = None,
+    current_user: Users = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db_session)
+):
+    if chat_id is not None and not await is_chat_member(db, chat_id, current_user.id):
         raise HTTPException(status_code=403, detail="You are not a participant of this chat")
 
-    messages_stmt = (
-        select(Messages)
-        .where(Messages.chat_id == chat_id)
-        .order_by(Messages.timestamp.asc())  
-        .limit(limit)
-        .offset(offset)
-    )
-    result = await db.execute(messages_stmt)
-    messages = result.scalars().all()
+    try:
+        after = decode_search_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
 
-    return messages
+    result = await db.execute(search_messages(current_user.id, q, limit + 1, after=after, chat_id=chat_id))
+    results = result.all()
 
+    has_more = len(results) > limit
+    results = results[:limit]
+    next_cursor = encode_search_cursor(results[-1]) if has_more else None
+    return FastJSONResponse({"results": [serialize_message(r) for r in results], "next_cursor": next_cursor})
+
+
+# Изменения во всех чатах пользователя после токена since, страницами не
+# больше limit. Без since отдаётся только токен текущего положения: клиент
+# загружает чаты и историю обычными запросами и дальше синхронизируется от него
+@router.get("/sync", response_model=SyncPageResponse)
+async def sync_changes(
+    since: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=500),
+    current_user: Users = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db_session)
+):
+    horizon = await db.scalar(select(SYNC_HORIZON))
+    if not since:
+        return FastJSONResponse({"changes": [], "next_token": encode_sync_token((horizon, 0)), "has_more": False})
+
+    try:
+        position, issued_at = decode_sync_token(since)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid sync token")
+
+    # Журнал за пределами срока хранения уже удалён - нужна полная загрузка
+    retention = settings.SYNC_RETENTION_DAYS * 86400
+    if retention and issued_at < time.time() - retention:
+        raise HTTPException(status_code=410, detail="Sync token expired")
+
+    result = await db.execute(sync_query(current_user.id, position, horizon, limit + 1))
+    changes = result.all()
+
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    if has_more:
+        position = (changes[-1].txid, changes[-1].id)
+    else:
+        position = max(position, (horizon, 0))
+    return FastJSONResponse({
+        "changes": [serialize_change(c) for c in changes],
+        "next_token": encode_sync_token(position),
+        "has_more": has_more
+    })
 
 
 @router.post("/groups")
 async def create_group(payload: GroupCreateSchema, current_user: Users = Depends(get_current_user), db: AsyncSession = Depends(get_db_session)):
-    new_group = Groups(
-        title=payload.title,
-        creator_id=payload.creator_id,
-    )
-    db.add(new_group)
-    await db.commit()
-    await db.refresh(new_group)
     users_ids = [payload.creator_id] + payload.user_ids
+    await check_users_exist(db, users_ids)
 
-    creator = GroupUser(group_id=new_group.id, user_id=payload.creator_id)
-    db.add(creator)
-    for user_id in payload.user_ids:
-        group_user = GroupUser(group_id=new_group.id, user_id=user_id)
-        db.add(group_user)
-
-    new_chat = Chats(
-        title=payload.title,   
-        chats_type=ChatType.GROUP
-    )
+    # Группа, её чат и участники создаются одной транзакцией
+    new_chat = Chats(title=payload.title, chats_type=ChatType.GROUP)
     db.add(new_chat)
+    try:
+        await db.flush()
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(status_code=409, detail="Group title already taken")
 
-    await db.commit()
-    await db.refresh(new_chat)
-
-    for user_id in users_ids:
-        db.add(ChatUser(chat_id=new_chat.id, user_id=user_id))
+    new_group = Groups(title=payload.title, creator_id=payload.creator_id, chat_id=new_chat.id)
+    db.add(new_group)
+    await db.flush()
 
+    await add_group_members(db, new_group.id, new_chat.id, users_ids)
     await db.commit()
+    await invalidate_group(new_group.id)
+    await invalidate_chat(new_chat.id)
     return {"detail": "Group and chat created", "group_id": new_group.id}
 
 @router.get("/groups", response_model=List[GroupResponseSchema])
 async def list_groups(current_user: Users = Depends(get_current_user),db: AsyncSession = Depends(get_db_session)):
-    query = select(Groups).options(joinedload(Groups.users)).where(Groups.users.any(id=current_user.id))
+    user_groups = select(GroupUser.group_id).where(GroupUser.user_id == current_user.id)
+    query = (
+        select(Groups.id, Groups.title, Groups.creator_id, Users.id.label("user_id"), Users.username, Users.email)
+        .join(GroupUser, GroupUser.group_id == Groups.id)
+        .join(Users, Users.id == GroupUser.user_id)
+        .where(Groups.id.in_(user_groups))
+        .order_by(Groups.id)
+    )
     result = await db.execute(query)
-    return result.unique().scalars().all()
+
+    groups = {}
+    for row in result:
+        group = groups.get(row.id)
+        if group is None:
+            group = groups[row.id] = {"id": row.id, "title": row.title, "creator_id": row.creator_id, "users": []}
+        group["users"].append({"id": row.user_id, "username": row.username, "email": row.email})
+
+    return FastJSONResponse(list(groups.values()))
 
 
 @router.get("/groups/{group_id}/", response_model=GroupResponseSchema)
@@ -174,14 +366,13 @@ async def add_user_to_group(group_id: int, payload: AddUserToGroupSchema, curren
     if not group:
         raise HTTPException(status_code=404, detail="Group not found")
 
-    existing = await db.execute(
-        select(GroupUser).where(GroupUser.group_id == group_id, GroupUser.user_id == payload.user_id)
-    )
-    if existing.scalars().first():
+    await check_users_exist(db, [payload.user_id])
+    if not await add_group_members(db, group_id, group.chat_id, [payload.user_id]):
         raise HTTPException(status_code=400, detail="User already in group")
 
-    db.add(GroupUser(group_id=group_id, user_id=payload.user_id))
     await db.commit()
+    await invalidate_group(group_id)
+    await invalidate_chat(group.chat_id)
 
     return {"detail": "User added to group"}
 
@@ -189,13 +380,58 @@ async def add_user_to_group(group_id: int, payload: AddUserToGroupSchema, curren
 
 @router.delete("/groups/{group_id}/remove_user/{user_id}")
 async def remove_user_from_group(group_id: int, user_id: int, current_user: Users = Depends(get_current_user), db: AsyncSession = Depends(get_db_session)):
-    stmt = select(GroupUser).where(GroupUser.group_id == group_id, GroupUser.user_id == user_id)
-    result = await db.execute(stmt)
-    group_user = result.scalars().first()
+    result = await db.execute(select(Groups.chat_id).where(Groups.id == group_id))
+    chat_id = result.scalar()
 
-    if not group_user:
+    if not await remove_group_members(db, group_id, chat_id, [user_id]):
         raise HTTPException(status_code=404, detail="User not in group")
 
-    await db.delete(group_user)
     await db.commit()
+    await invalidate_group(group_id)
+    await invalidate_chat(chat_id)
     return {"detail": "User removed from group"}
+
+
+async def get_member_group(db: AsyncSession, group_id: int, user_id: int) -> Groups:
+    result = await db.execute(select(Groups).where(Groups.id == group_id))
+    group = result.scalars().first()
+    if not group:
+        raise HTTPException(status_code=404, detail="Group not found")
+    if not await is_group_member(db, group_id, user_id):
+        raise HTTPException(status_code=403, detail="You are not a member of this group")
+    return group
+
+
+@router.post("/groups/{group_id}/members")
+async def add_group_users(
+    group_id: int,
+    payload: BulkMembersSchema,
+    current_user: Users = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db_session)
+):
+    group = await get_member_group(db, group_id, current_user.id)
+    await check_users_exist(db, payload.user_ids)
+
+    added = await add_group_members(db, group_id, group.chat_id, payload.user_ids)
+    await db.commit()
+    await invalidate_group(group_id)
+    await invalidate_chat(group.chat_id)
+    return {"detail": "Users added to group", "user_ids": added}
+
+
+@router.post("/groups/{group_id}/members/remove")
+async def remove_group_users(
+    group_id: int,
+    payload: BulkMembersSchema,
+    current_user: Users = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db_session)
+):
+    group = await get_member_group(db, group_id, current_user.id)
+    if len(payload.user_ids) > settings.MEMBERSHIP_BULK_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {settings.MEMBERSHIP_BULK_MAX} users per request")
+
+    removed = await remove_group_members(db, group_id, group.chat_id, payload.user_ids)
+    await db.commit()
+    await invalidate_group(group_id)
+    await invalidate_chat(group.chat_id)
+    return {"detail": "Users removed from group", "user_ids": removed}
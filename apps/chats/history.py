@@ -0,0 +1,135 @@
+import base64
+from datetime import datetime, timezone
+
+from sqlalchemy import select, tuple_
+
+from apps.users.models import Chats, Messages
+from apps.chats.archive import archived_after, archived_before
+from apps.chats.recent import recent_messages
+
+
+# messages.id и messages.seq - integer в Postgres
+MAX_MESSAGE_ID = 2**31 - 1
+MAX_SEQ = 2**31 - 1
+
+
+# Из MessagePack могут прийти и inf, и числа больше bigint
+def parse_message_id(value) -> int:
+    try:
+        message_id = int(value)
+    except OverflowError:
+        raise ValueError("Message id out of range")
+    if not 0 <= message_id <= MAX_MESSAGE_ID:
+        raise ValueError("Message id out of range")
+    return message_id
+
+
+# Сообщения хранят время в UTC без часового пояса; время с поясом из курсора
+# приводится к тому же виду, иначе его нельзя сравнить ни с буфером и архивом,
+# ни с параметром запроса
+def parse_timestamp(value: str) -> datetime:
+    timestamp = datetime.fromisoformat(value)
+    if timestamp.tzinfo is not None:
+        try:
+            timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+        except OverflowError:
+            raise ValueError("Timestamp out of range")
+    return timestamp
+
+
+# Курсор истории - пара (timestamp, id) последнего/первого полученного сообщения
+def parse_cursor(cursor: dict) -> tuple[datetime, int]:
+    return parse_timestamp(cursor["timestamp"]), parse_message_id(cursor["id"])
+
+
+def make_cursor(message) -> dict:
+    return {"timestamp": message.timestamp.isoformat(), "id": message.id}
+
+
+# Непрозрачный курсор для REST: base64 от "timestamp|id"
+def encode_cursor(message) -> str:
+    raw = f"{message.timestamp.isoformat()}|{message.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    timestamp, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+    return parse_timestamp(timestamp), parse_message_id(message_id)
+
+
+# Сообщения выбираются строками, без ORM-объектов
+MESSAGE_COLUMNS = (Messages.id, Messages.chat_id, Messages.sender_id, Messages.text, Messages.timestamp, Messages.seq)
+
+
+def serialize_message(row) -> dict:
+    return row._asdict()
+
+
+# Новые сообщения первыми, строго раньше курсора before
+def history_page(chat_id: int, limit: int, before: tuple[datetime, int] = None):
+    stmt = select(*MESSAGE_COLUMNS).where(Messages.chat_id == chat_id)
+    if before is not None:
+        stmt = stmt.where(tuple_(Messages.timestamp, Messages.id) < tuple_(*before))
+    return stmt.order_by(Messages.timestamp.desc(), Messages.id.desc()).limit(limit)
+
+
+# Старые сообщения первыми, строго позже курсора after
+def history_page_after(chat_id: int, limit: int, after: tuple[datetime, int] = None):
+    stmt = select(*MESSAGE_COLUMNS).where(Messages.chat_id == chat_id)
+    if after is not None:
+        stmt = stmt.where(tuple_(Messages.timestamp, Messages.id) > tuple_(*after))
+    return stmt.order_by(Messages.timestamp.asc(), Messages.id.asc()).limit(limit)
+
+
+# Сообщения после номера since_seq по возрастанию номера
+def history_since_seq(chat_id: int, since_seq: int, limit: int):
+    return (
+        select(*MESSAGE_COLUMNS)
+        .where(Messages.chat_id == chat_id, Messages.seq > since_seq)
+        .order_by(Messages.seq)
+        .limit(limit)
+    )
+
+
+# Перед чтением из буфера последних сообщений его хвост сверяется с базой
+async def check_recent(db, chat_id: int):
+    if recent_messages.stale(chat_id):
+        result = await db.execute(select(Chats.last_seq).where(Chats.id == chat_id))
+        recent_messages.check(chat_id, result.scalar())
+
+
+# Страница истории с учётом архива: выгруженные секции всегда старше
+# оставшихся в базе, поэтому архив дочитывается только за пределами базы.
+# Сначала страница ищется среди последних сообщений чата в памяти, а
+# последние сообщения, прочитанные из базы, кладутся туда
+async def load_history_before(db, chat_id: int, limit: int, before: tuple[datetime, int] = None) -> list:
+    await check_recent(db, chat_id)
+    messages = recent_messages.before(chat_id, limit, before=before)
+    if messages is not None:
+        return messages
+
+    result = await db.execute(history_page(chat_id, limit, before=before))
+    messages = result.all()
+    if len(messages) < limit:
+        cursor = (messages[-1].timestamp, messages[-1].id) if messages else before
+        messages += await archived_before(chat_id, limit - len(messages), before=cursor)
+    if before is None:
+        recent_messages.seed(chat_id, messages[::-1], complete=len(messages) < limit)
+    return messages
+
+
+async def load_history_after(db, chat_id: int, limit: int, after: tuple[datetime, int] = None) -> list:
+    await check_recent(db, chat_id)
+    messages = recent_messages.after(chat_id, limit, after=after)
+    if messages is not None:
+        return messages
+
+    messages = await archived_after(chat_id, limit, after=after)
+    if len(messages) < limit:
+        cursor = (messages[-1].timestamp, messages[-1].id) if messages else after
+        result = await db.execute(history_page_after(chat_id, limit - len(messages), after=cursor))
+        messages += result.all()
+    # Весь чат уместился в страницу
+    if after is None and len(messages) < limit:
+        recent_messages.seed(chat_id, messages, complete=True)
+    return messages
@@ -0,0 +1,80 @@
+import base64
+from datetime import datetime
+
+from sqlalchemy import and_, func, literal, select, tuple_, true
+from sqlalchemy.orm import aliased
+
+from apps.users.models import ChatRead, ChatUser, Chats, Messages
+
+
+# Чаты без сообщений идут в конце списка
+NO_ACTIVITY = datetime(1970, 1, 1)
+
+
+def encode_inbox_cursor(row) -> str:
+    raw = f"{row.activity.isoformat()}|{row.chat_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_inbox_cursor(cursor: str) -> tuple[datetime, int]:
+    activity, chat_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+    return datetime.fromisoformat(activity), int(chat_id)
+
+
+# Список чатов пользователя с последним сообщением и числом непрочитанных
+# одним запросом: последнее сообщение берётся по Chats.last_message_id,
+# непрочитанные считаются LATERAL-подзапросом по индексу (chat_id, id)
+def inbox_query(user_id: int, limit: int, before: tuple[datetime, int] = None):
+    activity = func.coalesce(Chats.last_message_at, literal(NO_ACTIVITY))
+    last_read = func.coalesce(ChatRead.last_read_message_id, 0)
+
+    unread_messages = aliased(Messages)
+    unread = (
+        select(func.count().label("unread"))
+        .where(
+            unread_messages.chat_id == Chats.id,
+            unread_messages.id > last_read,
+            unread_messages.sender_id != user_id
+        )
+        .lateral("unread")
+    )
+
+    stmt = (
+        select(
+            Chats.id.label("chat_id"),
+            Chats.title,
+            Chats.chats_type,
+            activity.label("activity"),
+            Messages.id.label("message_id"),
+            Messages.sender_id,
+            Messages.text,
+            Messages.timestamp,
+            unread.c.unread,
+        )
+        .select_from(Chats)
+        .outerjoin(ChatRead, and_(ChatRead.chat_id == Chats.id, ChatRead.user_id == user_id))
+        .outerjoin(Messages, and_(Messages.id == Chats.last_message_id, Messages.timestamp == Chats.last_message_at))
+        .join(unread, true())
+        .where(Chats.id.in_(select(ChatUser.chat_id).where(ChatUser.user_id == user_id)))
+    )
+    if before is not None:
+        stmt = stmt.where(tuple_(activity, Chats.id) < tuple_(*before))
+    return stmt.order_by(activity.desc(), Chats.id.desc()).limit(limit)
+
+
+def serialize_inbox_row(row) -> dict:
+    last_message = None
+    if row.message_id is not None:
+        last_message = {
+            "id": row.message_id,
+            "sender_id": row.sender_id,
+            "text": row.text,
+            "timestamp": row.timestamp,
+        }
+    return {
+        "chat_id": row.chat_id,
+        "title": row.title,
+        "chats_type": row.chats_type.value,
+        "last_message": last_message,
+        "unread": row.unread,
+    }
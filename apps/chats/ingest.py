@@ -0,0 +1,185 @@
+import asyncio
+import time
+
+from sqlalchemy import Integer, bindparam, insert, or_, text, update
+from sqlalchemy.dialects.postgresql import ARRAY
+
+from apps.database import db_session
+from apps.metrics import Counter, Gauge, Histogram
+from apps.settings import settings
+from apps.users.models import ChangeLog, Chats, Messages
+from apps.chats.history import MESSAGE_COLUMNS
+from apps.chats.sync import message_changes
+
+
+SYNCHRONOUS_COMMIT = ("on", "off", "local", "remote_write", "remote_apply")
+
+ingest_messages = Counter("ingest_messages_total", "Messages written by the ingest pipeline")
+ingest_failed = Counter("ingest_failed_total", "Messages whose batch failed to write")
+ingest_queue_depth = Gauge("ingest_queue_depth", "Messages waiting for the next ingest batch")
+ingest_batch_size = Histogram(
+    "ingest_batch_size", "Messages per ingest batch", buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+)
+ingest_commit = Histogram("ingest_commit_seconds", "Time to insert and commit one ingest batch")
+ingest_wait = Histogram("ingest_wait_seconds", "Time from submit until the message is committed")
+
+
+# Последнее сообщение каждого чата пачки записывается в Chats. Чаты
+# обновляются по возрастанию id, чтобы параллельные пачки не блокировали
+# друг друга, а условие по id не даёт откатить более новое значение
+LAST_MESSAGE_UPDATE = (
+    update(Chats.__table__)
+    .where(
+        Chats.id == bindparam("b_chat_id"),
+        or_(Chats.last_message_id.is_(None), Chats.last_message_id < bindparam("b_id"))
+    )
+    .values(last_message_id=bindparam("b_id"), last_message_at=bindparam("b_timestamp"))
+)
+
+
+# Номера сообщений выделяются одним UPDATE на всю пачку: last_seq каждого
+# чата увеличивается на число его сообщений. Строки чатов блокируются по
+# возрастанию id, как и в LAST_MESSAGE_UPDATE
+SEQ_ALLOCATE = text("""
+    UPDATE chats SET last_seq = chats.last_seq + b.count
+    FROM (
+        SELECT chats.id, b.count
+        FROM chats JOIN unnest(:chat_ids, :counts) AS b(chat_id, count) ON chats.id = b.chat_id
+        ORDER BY chats.id
+        FOR UPDATE OF chats
+    ) AS b
+    WHERE chats.id = b.id
+    RETURNING chats.id, chats.last_seq
+""").bindparams(
+    bindparam("chat_ids", type_=ARRAY(Integer)),
+    bindparam("counts", type_=ARRAY(Integer)),
+)
+
+
+async def allocate_seq(db, values: list[dict]):
+    counts = {}
+    for v in values:
+        counts[v["chat_id"]] = counts.get(v["chat_id"], 0) + 1
+    result = await db.execute(SEQ_ALLOCATE, {"chat_ids": list(counts), "counts": list(counts.values())})
+    # Сообщения чата получают номера по порядку поступления в пачку.
+    # У удалённого чата номера нет, и INSERT такой строки завершится ошибкой
+    next_seq = {chat_id: last_seq - counts[chat_id] + 1 for chat_id, last_seq in result}
+    for v in values:
+        seq = next_seq.get(v["chat_id"])
+        v["seq"] = seq
+        if seq is not None:
+            next_seq[v["chat_id"]] += 1
+
+
+def last_messages(rows) -> list[dict]:
+    latest = {}
+    for row in rows:
+        if row.chat_id not in latest or row.id > latest[row.chat_id].id:
+            latest[row.chat_id] = row
+    return [
+        {"b_chat_id": chat_id, "b_id": row.id, "b_timestamp": row.timestamp}
+        for chat_id, row in sorted(latest.items())
+    ]
+
+
+# Сообщения со всех сокетов копятся в очереди и записываются одним
+# многострочным INSERT ... RETURNING в одной транзакции: пачка уходит,
+# когда набралось INGEST_BATCH_SIZE сообщений или прошло INGEST_MAX_DELAY_MS.
+# Отправитель ждёт id и timestamp своего сообщения и только потом рассылает его.
+class IngestPipeline:
+    def __init__(self):
+        self._queue: asyncio.Queue = None
+        self._task = None
+
+    async def start(self):
+        if settings.INGEST_SYNCHRONOUS_COMMIT not in SYNCHRONOUS_COMMIT:
+            raise ValueError(f"Unknown synchronous_commit mode: {settings.INGEST_SYNCHRONOUS_COMMIT}")
+        self._queue = asyncio.Queue(maxsize=settings.INGEST_QUEUE_SIZE)
+        ingest_queue_depth.set_function(self._queue.qsize)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+        # Дописываем то, что успело попасть в очередь
+        batch = []
+        while not self._queue.empty():
+            batch.append(self._queue.get_nowait())
+        if batch:
+            await self._flush(batch)
+
+    async def submit(self, chat_id: int, sender_id: int, text: str):
+        future = asyncio.get_running_loop().create_future()
+        started = time.perf_counter()
+        await self._queue.put(({"chat_id": chat_id, "sender_id": sender_id, "text": text}, future))
+        try:
+            return await future
+        finally:
+            ingest_wait.observe(time.perf_counter() - started)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + settings.INGEST_MAX_DELAY_MS / 1000
+
+            while len(batch) < settings.INGEST_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        ingest_batch_size.observe(len(batch))
+        if not await self._commit(batch) and len(batch) > 1:
+            # Одна плохая строка (например, чат удалён, пока сообщение ждало в
+            # очереди) роняет весь INSERT, поэтому пачка повторяется по одному
+            # сообщению и ошибку получают только отправители плохих строк
+            for item in batch:
+                await self._commit([item], split_on_error=False)
+
+    async def _commit(self, batch, split_on_error: bool = True) -> bool:
+        started = time.perf_counter()
+        try:
+            rows = await self._write([v for v, _ in batch])
+        except Exception as e:
+            if split_on_error and len(batch) > 1:
+                return False
+            ingest_failed.inc(len(batch))
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return False
+
+        ingest_commit.observe(time.perf_counter() - started)
+        ingest_messages.inc(len(rows))
+        for (_, future), row in zip(batch, rows):
+            if not future.done():
+                future.set_result(row)
+        return True
+
+    async def _write(self, values: list[dict]) -> list:
+        async with db_session() as db:
+            if settings.INGEST_SYNCHRONOUS_COMMIT != "on":
+                await db.execute(text(f"SET LOCAL synchronous_commit = {settings.INGEST_SYNCHRONOUS_COMMIT}"))
+
+            await allocate_seq(db, values)
+            stmt = insert(Messages).returning(*MESSAGE_COLUMNS, sort_by_parameter_order=True)
+            result = await db.execute(stmt, values)
+            rows = result.all()
+            await db.execute(LAST_MESSAGE_UPDATE, last_messages(rows))
+            await db.execute(insert(ChangeLog), message_changes(rows))
+            await db.commit()
+        return rows
+
+ingest = IngestPipeline()
@@ -0,0 +1,150 @@
+from sqlalchemy import Integer, any_, bindparam, delete, func, literal, select
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from apps.broadcast import broadcast
+from apps.cache import TTLCache
+from apps.serialization import loads
+from apps.settings import settings
+from apps.users.models import ChatUser, GroupUser, Groups, Users
+from apps.chats.sync import MEMBER_ADDED, MEMBER_REMOVED, log_members
+
+
+# Индекс участников для проверки доступа без запроса в базу:
+# chat_id -> участники чата, group_id -> участники группы, group_id -> chat_id.
+# Изменения участников сбрасывают записи на всех worker'ах через broadcast
+chat_members = TTLCache(maxsize=settings.MEMBERSHIP_CACHE_SIZE, ttl=settings.MEMBERSHIP_CACHE_TTL)
+group_members = TTLCache(maxsize=settings.MEMBERSHIP_CACHE_SIZE, ttl=settings.MEMBERSHIP_CACHE_TTL)
+group_chats = TTLCache(maxsize=settings.MEMBERSHIP_CACHE_SIZE, ttl=settings.MEMBERSHIP_CACHE_TTL)
+
+INVALIDATION_ROOM = "membership"
+
+
+async def get_chat_members(db: AsyncSession, chat_id: int) -> frozenset[int]:
+    members = chat_members.get(chat_id)
+    if members is None:
+        result = await db.execute(select(ChatUser.user_id).where(ChatUser.chat_id == chat_id))
+        members = frozenset(result.scalars().all())
+        chat_members.set(chat_id, members)
+    return members
+
+
+async def get_group_members(db: AsyncSession, group_id: int) -> frozenset[int]:
+    members = group_members.get(group_id)
+    if members is None:
+        result = await db.execute(select(GroupUser.user_id).where(GroupUser.group_id == group_id))
+        members = frozenset(result.scalars().all())
+        group_members.set(group_id, members)
+    return members
+
+
+async def get_group_chat_id(db: AsyncSession, group_id: int) -> int:
+    chat_id = group_chats.get(group_id)
+    if chat_id is None:
+        result = await db.execute(select(Groups.chat_id).where(Groups.id == group_id))
+        chat_id = result.scalar()
+        if chat_id is not None:
+            group_chats.set(group_id, chat_id)
+    return chat_id
+
+
+async def is_chat_member(db: AsyncSession, chat_id: int, user_id: int) -> bool:
+    return user_id in await get_chat_members(db, chat_id)
+
+
+async def is_group_member(db: AsyncSession, group_id: int, user_id: int) -> bool:
+    return user_id in await get_group_members(db, group_id)
+
+
+# Массовое изменение участников: каждая операция - один запрос, а список
+# id передаётся одним параметром-массивом, сколько бы пользователей ни было.
+# Коммит и сброс кэшей остаются вызывающему, чтобы всё шло одной транзакцией
+def _ids_param(user_ids):
+    return bindparam("user_ids", sorted(set(user_ids)), type_=ARRAY(Integer))
+
+
+async def find_missing_users(db: AsyncSession, user_ids) -> list[int]:
+    result = await db.execute(select(Users.id).where(Users.id == any_(_ids_param(user_ids))))
+    return sorted(set(user_ids) - set(result.scalars().all()))
+
+
+def _insert_members(table, column, owner_id: int, user_ids):
+    rows = select(literal(owner_id, Integer), func.unnest(_ids_param(user_ids)))
+    return (
+        pg_insert(table)
+        .from_select([column, "user_id"], rows)
+        .on_conflict_do_nothing(index_elements=[column, "user_id"])
+        .returning(table.user_id)
+    )
+
+
+async def add_chat_members(db: AsyncSession, chat_id: int, user_ids) -> list[int]:
+    result = await db.execute(_insert_members(ChatUser, "chat_id", chat_id, user_ids))
+    added = result.scalars().all()
+    await log_members(db, chat_id, MEMBER_ADDED, added)
+    return added
+
+
+async def remove_chat_members(db: AsyncSession, chat_id: int, user_ids) -> list[int]:
+    stmt = (
+        delete(ChatUser)
+        .where(ChatUser.chat_id == chat_id, ChatUser.user_id == any_(_ids_param(user_ids)))
+        .returning(ChatUser.user_id)
+    )
+    result = await db.execute(stmt)
+    removed = result.scalars().all()
+    await log_members(db, chat_id, MEMBER_REMOVED, removed)
+    return removed
+
+
+# Участники группы всегда состоят и в её чате
+async def add_group_members(db: AsyncSession, group_id: int, chat_id: int, user_ids) -> list[int]:
+    result = await db.execute(_insert_members(GroupUser, "group_id", group_id, user_ids))
+    added = result.scalars().all()
+    if chat_id is not None:
+        await add_chat_members(db, chat_id, user_ids)
+    return added
+
+
+async def remove_group_members(db: AsyncSession, group_id: int, chat_id: int, user_ids) -> list[int]:
+    stmt = (
+        delete(GroupUser)
+        .where(GroupUser.group_id == group_id, GroupUser.user_id == any_(_ids_param(user_ids)))
+        .returning(GroupUser.user_id)
+    )
+    result = await db.execute(stmt)
+    removed = result.scalars().all()
+    if chat_id is not None:
+        await remove_chat_members(db, chat_id, removed)
+    return removed
+
+
+async def invalidate_chat(chat_id: int):
+    chat_members.pop(chat_id)
+    await broadcast.publish(INVALIDATION_ROOM, {"chat_id": chat_id})
+
+
+async def invalidate_group(group_id: int):
+    group_members.pop(group_id)
+    group_chats.pop(group_id)
+    await broadcast.publish(INVALIDATION_ROOM, {"group_id": group_id})
+
+
+async def _on_invalidate(data: str):
+    message = loads(data)
+    if "chat_id" in message:
+        chat_members.pop(message["chat_id"])
+    if "group_id" in message:
+        group_members.pop(message["group_id"])
+        group_chats.pop(message["group_id"])
+
+
+# Сброс, пропущенный во время обрыва рассылки, уже не придёт
+def _clear_all():
+    chat_members.clear()
+    group_members.clear()
+    group_chats.clear()
+
+
+broadcast.subscribe(INVALIDATION_ROOM, _on_invalidate)
+broadcast.add_reconnect_listener(_clear_all)
@@ -0,0 +1,79 @@
+import re
+from datetime import date, datetime
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+
+# Сообщения хранятся в месячных секциях messages_pYYYY_MM; секция
+# messages_default принимает строки, для которых месячной секции ещё нет
+PARTITION_NAME = re.compile(r"messages_p(\d{4})_(\d{2})")
+
+
+def month_start(value) -> date:
+    return date(value.year, value.month, 1)
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: date) -> str:
+    return f"messages_p{month.year:04d}_{month.month:02d}"
+
+
+async def list_partitions(conn: AsyncConnection) -> list[tuple[str, datetime, datetime]]:
+    result = await conn.execute(text("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'messages'::regclass
+    """))
+    partitions = []
+    for name in result.scalars():
+        match = PARTITION_NAME.fullmatch(name)
+        if match:
+            start = date(int(match[1]), int(match[2]), 1)
+            partitions.append((name, datetime.combine(start, datetime.min.time()),
+                               datetime.combine(add_months(start, 1), datetime.min.time())))
+    return sorted(partitions, key=lambda p: p[1])
+
+
+async def ensure_partitions(conn: AsyncConnection, months_ahead: int):
+    current = month_start(datetime.utcnow())
+    existing = {name for name, _, _ in await list_partitions(conn)}
+    for i in range(months_ahead + 1):
+        month = add_months(current, i)
+        name = partition_name(month)
+        if name in existing:
+            continue
+        await create_partition(conn, name, month, add_months(month, 1))
+    await conn.commit()
+
+
+# Если за месяц уже есть строки в messages_default, Postgres не даст создать
+# секцию поверх них: секция создаётся отдельной таблицей, строки переносятся
+# в неё и она присоединяется в той же транзакции
+async def create_partition(conn: AsyncConnection, name: str, start: date, end: date):
+    bounds = f"FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+    in_range = f"timestamp >= '{start.isoformat()}' AND timestamp < '{end.isoformat()}'"
+    has_rows = await conn.scalar(text(f"SELECT EXISTS (SELECT 1 FROM messages_default WHERE {in_range})"))
+    if not has_rows:
+        await conn.execute(text(f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF messages FOR VALUES {bounds}"))
+        return
+
+    # Вычисляемые столбцы (search_vector) не переносятся, а считаются заново
+    result = await conn.execute(text("""
+        SELECT attname FROM pg_attribute
+        WHERE attrelid = 'messages'::regclass AND attnum > 0 AND NOT attisdropped AND attgenerated = ''
+        ORDER BY attnum
+    """))
+    columns = ", ".join(result.scalars())
+    await conn.execute(text(
+        f"CREATE TABLE {name} (LIKE messages INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING GENERATED)"
+    ))
+    await conn.execute(text(
+        f"WITH moved AS (DELETE FROM messages_default WHERE {in_range} RETURNING {columns}) "
+        f"INSERT INTO {name} ({columns}) SELECT {columns} FROM moved"
+    ))
+    await conn.execute(text(f"ALTER TABLE messages ATTACH PARTITION {name} FOR VALUES {bounds}"))
@@ -0,0 +1,57 @@
+from datetime import datetime
+
+from sqlalchemy import and_, func, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from apps.users.models import ChatRead, ChatUser, Messages
+from apps.chats.sync import log_read
+
+
+# Прочитанность хранится курсором на пользователя и чат: отметка о прочтении -
+# это upsert одной строки, курсор только растёт. В журнал изменений попадают
+# только отметки, которые сдвинули курсор. id от клиента не может быть больше
+# последнего сообщения чата, иначе курсор навсегда ушёл бы вперёд
+async def mark_read(db: AsyncSession, user_id: int, chat_id: int, message_id: int = None):
+    latest = (
+        select(func.coalesce(func.max(Messages.id), 0))
+        .where(Messages.chat_id == chat_id)
+        .scalar_subquery()
+    )
+    message_id = latest if message_id is None else func.least(message_id, latest)
+
+    stmt = pg_insert(ChatRead).values(
+        user_id=user_id,
+        chat_id=chat_id,
+        last_read_message_id=message_id,
+        updated_at=datetime.utcnow()
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ChatRead.user_id, ChatRead.chat_id],
+        set_={
+            "last_read_message_id": stmt.excluded.last_read_message_id,
+            "updated_at": stmt.excluded.updated_at
+        },
+        where=ChatRead.last_read_message_id < stmt.excluded.last_read_message_id
+    ).returning(ChatRead.last_read_message_id)
+    result = await db.execute(stmt)
+    last_read = result.scalar()
+    if last_read is not None:
+        await log_read(db, user_id, chat_id, last_read)
+    await db.commit()
+
+
+# Непрочитанные сообщения во всех чатах пользователя одним запросом
+def unread_counts_query(user_id: int):
+    return (
+        select(ChatUser.chat_id, func.count(Messages.id).label("unread"))
+        .select_from(ChatUser)
+        .outerjoin(ChatRead, and_(ChatRead.user_id == ChatUser.user_id, ChatRead.chat_id == ChatUser.chat_id))
+        .outerjoin(Messages, and_(
+            Messages.chat_id == ChatUser.chat_id,
+            Messages.id > func.coalesce(ChatRead.last_read_message_id, 0),
+            Messages.sender_id != ChatUser.user_id
+        ))
+        .where(ChatUser.user_id == user_id)
+        .group_by(ChatUser.chat_id)
+    )
@@ -0,0 +1,201 @@
+import sys
+import time
+from collections import OrderedDict, deque, namedtuple
+from datetime import datetime
+
+from apps.broadcast import broadcast
+from apps.metrics import Counter, Gauge
+from apps.serialization import loads
+from apps.settings import settings
+
+resume_requests = Counter("ws_resume_total", "Reconnects with since_seq by where the gap was served from", ("source",))
+recent_history = Counter(
+    "recent_messages_history_total", "History pages by whether the in-memory buffer covered them", ("result",)
+)
+recent_evicted = Counter("recent_messages_evicted_total", "Chats evicted from the in-memory buffer by the memory limit")
+recent_stale = Counter("recent_messages_stale_total", "Chat buffers dropped because they missed messages in the database")
+recent_chats = Gauge("recent_messages_chats", "Chats kept in the in-memory buffer")
+recent_bytes = Gauge("recent_messages_bytes", "Approximate memory used by the in-memory buffer")
+
+# Кадры сообщений собирает handle_send, поэтому "type" у них всегда первый
+MESSAGE_FRAME_PREFIX = '{"type":"message"'
+
+RecentMessage = namedtuple("RecentMessage", ["id", "chat_id", "sender_id", "text", "timestamp", "seq"])
+
+# Примерный размер сообщения в памяти без текста: кортеж, числа и datetime
+MESSAGE_OVERHEAD = 200
+
+
+def message_size(message) -> int:
+    return MESSAGE_OVERHEAD + sys.getsizeof(message.text)
+
+
+def _key(message) -> tuple[datetime, int]:
+    return message.timestamp, message.id
+
+
+class _ChatBuffer:
+    def __init__(self, complete: bool = False):
+        self.messages: deque = deque()
+        self.size = 0
+        # В буфере вся история чата, а не только её хвост
+        self.complete = complete
+        # Когда хвост буфера последний раз сверялся с chats.last_seq
+        self.checked_at = None
+
+
+# Последние сообщения каждого чата по возрастанию seq. Сообщения приходят из
+# handle_send и из broadcast, так что при рассылке через Postgres здесь есть и
+# сообщения других worker'ов; при промахе буфер заполняется тем, что история прочитала из базы.
+# Хранится только непрерывный по seq хвост: если номер пропущен, буфер чата
+# начинается заново. Чаты вытесняются по давности последнего сообщения или
+# чтения, пока общий размер больше max_bytes.
+# Сообщение, не дошедшее через broadcast, буфер сам не заметит, поэтому перед
+# чтением он сверяется с базой (stale/check) - при первом чтении и затем не
+# чаще раза в check_interval секунд, а после обрыва рассылки сбрасывается
+class RecentMessages:
+    def __init__(self, per_chat: int, max_bytes: int, check_interval: float):
+        self.per_chat = per_chat
+        self.max_bytes = max_bytes
+        self.check_interval = check_interval
+        self.size = 0
+        self._chats: OrderedDict[int, _ChatBuffer] = OrderedDict()
+
+    def __len__(self):
+        return len(self._chats)
+
+    def add(self, message: RecentMessage):
+        chat = self._chats.get(message.chat_id)
+        if chat is not None and chat.messages:
+            last_seq = chat.messages[-1].seq
+            if message.seq <= last_seq:
+                return
+            if message.seq != last_seq + 1:
+                chat = None
+        if chat is None:
+            chat = self._replace(message.chat_id, _ChatBuffer())
+        self._append(chat, message)
+        self._chats.move_to_end(message.chat_id)
+        self._evict()
+
+    # Страница, прочитанная из базы: последние сообщения чата по возрастанию
+    # seq. Если в буфере уже есть более новые, они дописываются к странице
+    def seed(self, chat_id: int, messages: list, complete: bool):
+        if any(m.seq is None for m in messages):
+            return
+        chat = self._chats.get(chat_id)
+        if chat is not None and chat.messages:
+            first_seq = chat.messages[0].seq
+            if not messages or messages[-1].seq + 1 < first_seq:
+                return
+            messages = [m for m in messages if m.seq < first_seq] + list(chat.messages)
+        chat = self._replace(chat_id, _ChatBuffer(complete))
+        chat.checked_at = time.monotonic()
+        for message in messages:
+            self._append(chat, RecentMessage(*message))
+        self._evict()
+
+    def stale(self, chat_id: int) -> bool:
+        chat = self._chats.get(chat_id)
+        return chat is not None and (
+            chat.checked_at is None or time.monotonic() - chat.checked_at > self.check_interval
+        )
+
+    # Буфер, в хвосте которого нет последнего сохранённого сообщения, удаляется
+    def check(self, chat_id: int, last_seq: int):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            return
+        tail = chat.messages[-1].seq if chat.messages else 0
+        if last_seq is not None and tail >= last_seq:
+            chat.checked_at = time.monotonic()
+        else:
+            recent_stale.inc()
+            self.size -= self._chats.pop(chat_id).size
+
+    def clear(self):
+        self._chats.clear()
+        self.size = 0
+
+    # Новые первыми, строго раньше before, или None, если буфер их не покрывает
+    def before(self, chat_id: int, limit: int, before: tuple[datetime, int] = None) -> list:
+        chat = self._chats.get(chat_id)
+        if chat is not None:
+            messages = [m for m in chat.messages if before is None or _key(m) < before]
+            if len(messages) >= limit or chat.complete:
+                self._hit(chat_id)
+                return messages[-limit:][::-1]
+        recent_history.inc(result="miss")
+        return None
+
+    # Старые первыми, строго позже after, или None, если буфер их не покрывает
+    def after(self, chat_id: int, limit: int, after: tuple[datetime, int] = None) -> list:
+        chat = self._chats.get(chat_id)
+        if chat is not None and (
+            chat.complete or (after is not None and chat.messages and _key(chat.messages[0]) <= after)
+        ):
+            self._hit(chat_id)
+            return [m for m in chat.messages if after is None or _key(m) > after][:limit]
+        recent_history.inc(result="miss")
+        return None
+
+    # Сообщения строго после since_seq или None, если буфер их не покрывает
+    def since(self, chat_id: int, since_seq: int) -> list:
+        chat = self._chats.get(chat_id)
+        if chat is None or not chat.messages or chat.messages[0].seq > since_seq + 1:
+            return None
+        self._chats.move_to_end(chat_id)
+        return [m for m in chat.messages if m.seq > since_seq]
+
+    def on_dispatch(self, room: str, data: str):
+        if not data.startswith(MESSAGE_FRAME_PREFIX):
+            return
+        frame = loads(data)
+        if frame.get("seq") is None:
+            return
+        self.add(RecentMessage(
+            frame["id"],
+            frame["chat_id"],
+            frame["sender_id"],
+            frame["text"],
+            datetime.fromisoformat(frame["timestamp"]),
+            frame["seq"],
+        ))
+
+    def _hit(self, chat_id: int):
+        recent_history.inc(result="hit")
+        self._chats.move_to_end(chat_id)
+
+    def _append(self, chat: _ChatBuffer, message: RecentMessage):
+        chat.messages.append(message)
+        size = message_size(message)
+        chat.size += size
+        self.size += size
+        if len(chat.messages) > self.per_chat:
+            size = message_size(chat.messages.popleft())
+            chat.size -= size
+            self.size -= size
+            chat.complete = False
+
+    def _replace(self, chat_id: int, chat: _ChatBuffer) -> _ChatBuffer:
+        old = self._chats.pop(chat_id, None)
+        if old is not None:
+            self.size -= old.size
+        self._chats[chat_id] = chat
+        return chat
+
+    # Последний добавленный чат не вытесняется, даже если он один больше лимита
+    def _evict(self):
+        while self.size > self.max_bytes and len(self._chats) > 1:
+            _, chat = self._chats.popitem(last=False)
+            self.size -= chat.size
+            recent_evicted.inc()
+
+
+recent_messages = RecentMessages(
+    settings.RECENT_MESSAGES_PER_CHAT, settings.RECENT_MESSAGES_MAX_BYTES, settings.RECENT_MESSAGES_CHECK_INTERVAL
+)
+broadcast.add_listener(recent_messages.on_dispatch)
+broadcast.add_reconnect_listener(recent_messages.clear)
+recent_chats.set_function(lambda: len(recent_messages))
+recent_bytes.set_function(lambda: recent_messages.size)
@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 from datetime import datetime
 from apps.users.models import ChatType
 
@@ -26,11 +26,55 @@ class MessageResponse(BaseModel):
     sender_id: int
     text: str
     timestamp: datetime
-    is_read: bool
+    seq: Optional[int] = None
 
     class Config:
         orm_mode = True
 
+class MessagePageResponse(BaseModel):
+    messages: List[MessageResponse]
+    next_cursor: Optional[str] = None
+
+class SearchResultResponse(MessageResponse):
+    rank: float
+
+class SearchPageResponse(BaseModel):
+    results: List[SearchResultResponse]
+    next_cursor: Optional[str] = None
+
+class InboxMessageResponse(BaseModel):
+    id: int
+    sender_id: int
+    text: str
+    timestamp: datetime
+
+class InboxChatResponse(BaseModel):
+    chat_id: int
+    title: str
+    chats_type: ChatType
+    last_message: Optional[InboxMessageResponse] = None
+    unread: int
+
+class InboxPageResponse(BaseModel):
+    chats: List[InboxChatResponse]
+    next_cursor: Optional[str] = None
+
+class SyncChangeResponse(BaseModel):
+    kind: str
+    chat_id: int
+    user_id: Optional[int] = None
+    message_id: Optional[int] = None
+    message: Optional[MessageResponse] = None
+
+class SyncPageResponse(BaseModel):
+    changes: List[SyncChangeResponse]
+    next_token: str
+    has_more: bool
+
+class UnreadCountResponse(BaseModel):
+    chat_id: int
+    unread: int
+
 class UserResponse(BaseModel):
     id: int
     username: str
@@ -57,3 +101,7 @@ class GroupResponseSchema(BaseModel):
 
 class AddUserToGroupSchema(BaseModel):
     user_id: int
+
+
+class BulkMembersSchema(BaseModel):
+    user_ids: List[int]
@@ -0,0 +1,41 @@
+import base64
+
+from sqlalchemy import func, select, tuple_
+
+from apps.users.models import ChatUser, Messages
+from apps.chats.history import MESSAGE_COLUMNS
+
+
+# Должна совпадать с конфигурацией в выражении Messages.search_vector,
+# иначе индекс не будет использоваться
+SEARCH_CONFIG = "simple"
+
+
+# Курсор поиска - пара (rank, id) последнего результата страницы
+def encode_search_cursor(row) -> str:
+    raw = f"{row.rank!r}|{row.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_search_cursor(cursor: str) -> tuple[float, int]:
+    rank, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+    return float(rank), int(message_id)
+
+
+# Сообщения из чатов пользователя, подходящие под запрос, по убыванию
+# релевантности. Строки выбирает GIN-индекс по search_vector, rank
+# считается только для них
+def search_messages(user_id: int, query: str, limit: int, after: tuple[float, int] = None, chat_id: int = None):
+    tsquery = func.websearch_to_tsquery(SEARCH_CONFIG, query)
+    rank = func.ts_rank(Messages.search_vector, tsquery).label("rank")
+
+    user_chats = select(ChatUser.chat_id).where(ChatUser.user_id == user_id)
+    stmt = (
+        select(*MESSAGE_COLUMNS, rank)
+        .where(Messages.search_vector.op("@@")(tsquery), Messages.chat_id.in_(user_chats))
+    )
+    if chat_id is not None:
+        stmt = stmt.where(Messages.chat_id == chat_id)
+    if after is not None:
+        stmt = stmt.where(tuple_(rank, Messages.id) < tuple_(*after))
+    return stmt.order_by(rank.desc(), Messages.id.desc()).limit(limit)
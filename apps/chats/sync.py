@@ -0,0 +1,113 @@
+import base64
+import time
+from datetime import datetime
+
+from sqlalchemy import BigInteger, and_, delete, insert, literal, literal_column, or_, select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from apps.users.models import ChangeLog, ChatUser, Messages
+
+
+MESSAGE = "message"
+MEMBER_ADDED = "member_added"
+MEMBER_REMOVED = "member_removed"
+READ = "read"
+
+# txid и change_log.id - bigint
+MAX_POSITION = 2**63 - 1
+
+# Все транзакции с номером меньше xmin текущего снимка уже завершены, поэтому
+# строки журнала ниже этой границы больше не появятся
+SYNC_HORIZON = literal_column("pg_snapshot_xmin(pg_current_snapshot())::text::bigint", BigInteger)
+
+
+def message_changes(rows) -> list[dict]:
+    return [
+        {"chat_id": row.chat_id, "kind": MESSAGE, "message_id": row.id, "message_at": row.timestamp}
+        for row in rows
+    ]
+
+
+async def log_members(db: AsyncSession, chat_id: int, kind: str, user_ids):
+    if user_ids:
+        await db.execute(insert(ChangeLog), [
+            {"chat_id": chat_id, "kind": kind, "user_id": user_id} for user_id in user_ids
+        ])
+
+
+async def log_read(db: AsyncSession, user_id: int, chat_id: int, message_id: int):
+    await db.execute(insert(ChangeLog).values(chat_id=chat_id, kind=READ, user_id=user_id, message_id=message_id))
+
+
+async def prune_changes(db: AsyncSession, before: datetime) -> int:
+    result = await db.execute(delete(ChangeLog).where(ChangeLog.created_at < before))
+    await db.commit()
+    return result.rowcount
+
+
+# Изменения во всех чатах пользователя после курсора (txid, id) и ниже границы
+# horizon, старые первыми. Граница берётся отдельным запросом до выборки, иначе
+# транзакции, закоммиченные между ними, оказались бы позади курсора.
+# Удаление из чата пользователь видит, хотя уже в нём не состоит
+def sync_query(user_id: int, since: tuple[int, int], horizon: int, limit: int):
+    chat_ids = select(ChatUser.chat_id).where(ChatUser.user_id == user_id)
+    return (
+        select(
+            ChangeLog.id,
+            ChangeLog.txid,
+            ChangeLog.chat_id,
+            ChangeLog.kind,
+            ChangeLog.user_id,
+            ChangeLog.message_id,
+            Messages.sender_id,
+            Messages.text,
+            Messages.timestamp,
+            Messages.seq,
+        )
+        .outerjoin(Messages, and_(Messages.id == ChangeLog.message_id, Messages.timestamp == ChangeLog.message_at))
+        .where(
+            or_(
+                ChangeLog.chat_id.in_(chat_ids),
+                and_(ChangeLog.user_id == user_id, ChangeLog.kind == MEMBER_REMOVED),
+            ),
+            tuple_(ChangeLog.txid, ChangeLog.id) > tuple_(literal(since[0], BigInteger), literal(since[1], BigInteger)),
+            ChangeLog.txid < horizon,
+        )
+        .order_by(ChangeLog.txid, ChangeLog.id)
+        .limit(limit)
+    )
+
+
+def serialize_change(row) -> dict:
+    message = None
+    if row.kind == MESSAGE and row.timestamp is not None:
+        message = {
+            "id": row.message_id,
+            "chat_id": row.chat_id,
+            "sender_id": row.sender_id,
+            "text": row.text,
+            "timestamp": row.timestamp,
+            "seq": row.seq,
+        }
+    return {
+        "kind": row.kind,
+        "chat_id": row.chat_id,
+        "user_id": row.user_id,
+        "message_id": row.message_id,
+        "message": message,
+    }
+
+
+# Токен синхронизации: base64 от "txid|id|время выдачи". По времени выдачи
+# отсекаются токены старше срока хранения журнала
+def encode_sync_token(position: tuple[int, int]) -> str:
+    raw = f"{position[0]}|{position[1]}|{int(time.time())}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_sync_token(token: str) -> tuple[tuple[int, int], int]:
+    txid, change_id, issued_at = base64.urlsafe_b64decode(token.encode()).decode().split("|")
+    position = int(txid), int(change_id)
+    if not all(0 <= value <= MAX_POSITION for value in position):
+        raise ValueError("Sync token out of range")
+    return position, int(issued_at)
@@ -1,13 +1,101 @@
+import time
+
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from apps.metrics import Counter, Gauge, Histogram
 from apps.settings import settings
 
 
+db_pool_checked_out = Gauge("db_pool_checked_out", "Database connections currently checked out of the pool")
+db_pool_waiting = Gauge("db_pool_waiting", "Requests waiting for a database connection")
+db_pool_wait = Histogram("db_pool_wait_seconds", "Time spent waiting for a database connection")
+db_pool_idle = Gauge("db_pool_idle", "Idle connections kept in the pool")
+db_pool_overflow = Gauge("db_pool_overflow", "Connections opened above pool_size")
+db_query_duration = Histogram("db_query_duration_seconds", "Database statement execution time", ("operation",))
+db_query_errors = Counter("db_query_errors_total", "Database statements that raised an error", ("operation",))
+
+# Хуки трассировки запросов: hook(statement, parameters) вызывается перед
+# выполнением и может вернуть функцию finish(error), которую вызовут после
+# выполнения (error=None) или при ошибке. Так подключается, например, OpenTelemetry
+query_hooks: list = []
+
+
+def add_query_hook(hook):
+    query_hooks.append(hook)
+
+
+def remove_query_hook(hook):
+    query_hooks.remove(hook)
+
+
+# Пул с учётом ожидания свободного соединения
+class MeteredPool(AsyncAdaptedQueuePool):
+    def _do_get(self):
+        db_pool_waiting.inc()
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            db_pool_waiting.dec()
+            db_pool_wait.observe(time.perf_counter() - started)
+
+
+engine = create_async_engine(
+    settings.DATABASE_URL_asyncpg,
+    poolclass=MeteredPool,
+    pool_size=settings.DB_POOL_SIZE,
+    max_overflow=settings.DB_MAX_OVERFLOW,
+    pool_timeout=settings.DB_POOL_TIMEOUT,
+    pool_recycle=settings.DB_POOL_RECYCLE,
+    pool_pre_ping=settings.DB_POOL_PRE_PING,
+)
+
+
+@event.listens_for(engine.sync_engine.pool, "checkout")
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    db_pool_checked_out.inc()
+
+
+@event.listens_for(engine.sync_engine.pool, "checkin")
+def _on_checkin(dbapi_connection, connection_record):
+    db_pool_checked_out.dec()
+
+
+db_pool_idle.set_function(engine.sync_engine.pool.checkedin)
+db_pool_overflow.set_function(lambda: max(engine.sync_engine.pool.overflow(), 0))
+
+
+def _operation(statement: str) -> str:
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+    return operation if operation in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH") else "OTHER"
+
+
+@event.listens_for(engine.sync_engine, "before_cursor_execute")
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_started = time.perf_counter()
+    context._query_finishers = [f for f in (hook(statement, parameters) for hook in query_hooks) if f]
+
+
+@event.listens_for(engine.sync_engine, "after_cursor_execute")
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    db_query_duration.observe(time.perf_counter() - context._query_started, operation=_operation(statement))
+    for finish in context._query_finishers:
+        finish(None)
+
+
+@event.listens_for(engine.sync_engine, "handle_error")
+def _on_error(exception_context):
+    context = exception_context.execution_context
+    if context is None or not hasattr(context, "_query_started"):
+        return
+    db_query_errors.inc(operation=_operation(exception_context.statement or ""))
+    for finish in context._query_finishers:
+        finish(exception_context.original_exception)
 
-engine = create_async_engine(settings.DATABASE_URL_asyncpg)
 
 db_session = async_sessionmaker(engine, expire_on_commit=False)
 
 async def get_db_session():
     async with db_session() as session:
         yield session
-
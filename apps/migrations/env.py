@@ -1,3 +1,4 @@
+import re
 from logging.config import fileConfig
 
 from sqlalchemy import engine_from_config
@@ -19,6 +20,13 @@ config.set_main_option('sqlalchemy.url', settings.DATABASE_URL_asyncpg + "?async
 target_metadata = Base.metadata
 
 
+# Месячные секции messages создаются приложением и в моделях не описаны
+def include_name(name, type_, parent_names):
+    if type_ == "table":
+        return not re.fullmatch(r"messages_(p\d{4}_\d{2}|default)", name)
+    return True
+
+
 
 def run_migrations_offline() -> None:
     """Run migrations in 'offline' mode.
@@ -38,6 +46,7 @@ def run_migrations_offline() -> None:
         target_metadata=target_metadata,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
+        include_name=include_name,
     )
 
     with context.begin_transaction():
@@ -59,7 +68,7 @@ def run_migrations_online() -> None:
 
     with connectable.connect() as connection:
         context.configure(
-            connection=connection, target_metadata=target_metadata
+            connection=connection, target_metadata=target_metadata, include_name=include_name
         )
 
         with context.begin_transaction():
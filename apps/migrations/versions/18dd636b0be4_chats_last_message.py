@@ -0,0 +1,42 @@
+"""chats last message
+
+Revision ID: 18dd636b0be4
+Revises: 5c92a4e0502d
+Create Date: 2026-10-18 17:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '18dd636b0be4'
+down_revision: Union[str, None] = '5c92a4e0502d'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('chats', sa.Column('last_message_id', sa.Integer(), nullable=True))
+    op.add_column('chats', sa.Column('last_message_at', sa.DateTime(), nullable=True))
+    op.create_index(op.f('ix_chat_user_user_id'), 'chat_user', ['user_id'], unique=False)
+
+    op.execute("""
+        UPDATE chats SET last_message_id = m.id, last_message_at = m.timestamp
+        FROM (
+            SELECT DISTINCT ON (chat_id) chat_id, id, timestamp
+            FROM messages
+            ORDER BY chat_id, id DESC
+        ) m
+        WHERE m.chat_id = chats.id
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index(op.f('ix_chat_user_user_id'), table_name='chat_user')
+    op.drop_column('chats', 'last_message_at')
+    op.drop_column('chats', 'last_message_id')
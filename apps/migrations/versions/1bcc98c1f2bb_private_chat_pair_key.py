@@ -0,0 +1,52 @@
+"""private chat pair key
+
+Revision ID: 1bcc98c1f2bb
+Revises: be74a4bd0e31
+Create Date: 2026-10-18 13:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '1bcc98c1f2bb'
+down_revision: Union[str, None] = 'be74a4bd0e31'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('chats', sa.Column('min_user_id', sa.Integer(), nullable=True))
+    op.add_column('chats', sa.Column('max_user_id', sa.Integer(), nullable=True))
+
+    # Заполняем пару для существующих личных чатов; если для одной пары
+    # уже есть дубликаты, ключ получает самый ранний чат
+    op.execute("""
+        UPDATE chats SET min_user_id = pairs.min_user_id, max_user_id = pairs.max_user_id
+        FROM (
+            SELECT DISTINCT ON (min_user_id, max_user_id) chat_id, min_user_id, max_user_id
+            FROM (
+                SELECT cu.chat_id, min(cu.user_id) AS min_user_id, max(cu.user_id) AS max_user_id
+                FROM chat_user cu
+                JOIN chats c ON c.id = cu.chat_id
+                WHERE c.chats_type = 'PRIVATE'
+                GROUP BY cu.chat_id
+                HAVING count(DISTINCT cu.user_id) = 2
+            ) AS chat_pairs
+            ORDER BY min_user_id, max_user_id, chat_id
+        ) AS pairs
+        WHERE chats.id = pairs.chat_id
+    """)
+
+    op.create_index('uq_chats_private_pair', 'chats', ['min_user_id', 'max_user_id'], unique=True)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('uq_chats_private_pair', table_name='chats')
+    op.drop_column('chats', 'max_user_id')
+    op.drop_column('chats', 'min_user_id')
@@ -0,0 +1,46 @@
+"""message seq
+
+Revision ID: 33c19abcacc8
+Revises: 4e1ac2b0b0d4
+Create Date: 2026-10-18 21:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '33c19abcacc8'
+down_revision: Union[str, None] = '4e1ac2b0b0d4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('chats', sa.Column('last_seq', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('messages', sa.Column('seq', sa.Integer(), nullable=True))
+    op.execute("""
+        UPDATE messages m SET seq = n.seq
+        FROM (
+            SELECT id, timestamp, row_number() OVER (PARTITION BY chat_id ORDER BY timestamp, id) AS seq
+            FROM messages
+        ) n
+        WHERE m.id = n.id AND m.timestamp = n.timestamp
+    """)
+    op.execute("""
+        UPDATE chats c SET last_seq = m.last_seq
+        FROM (SELECT chat_id, max(seq) AS last_seq FROM messages GROUP BY chat_id) m
+        WHERE c.id = m.chat_id
+    """)
+    op.alter_column('messages', 'seq', nullable=False)
+    op.create_index('ix_messages_chat_id_seq', 'messages', ['chat_id', 'seq'], unique=False)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_messages_chat_id_seq', table_name='messages')
+    op.drop_column('messages', 'seq')
+    op.drop_column('chats', 'last_seq')
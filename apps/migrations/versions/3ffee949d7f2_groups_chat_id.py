@@ -0,0 +1,39 @@
+"""groups chat id
+
+Revision ID: 3ffee949d7f2
+Revises: 1bcc98c1f2bb
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3ffee949d7f2'
+down_revision: Union[str, None] = '1bcc98c1f2bb'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column('groups', sa.Column('chat_id', sa.Integer(), nullable=True))
+    op.create_index(op.f('ix_groups_chat_id'), 'groups', ['chat_id'], unique=False)
+    op.create_foreign_key('groups_chat_id_fkey', 'groups', 'chats', ['chat_id'], ['id'], ondelete='CASCADE')
+
+    # Раньше чат группы находился по совпадению названия
+    op.execute("""
+        UPDATE groups SET chat_id = chats.id
+        FROM chats
+        WHERE chats.title = groups.title AND chats.chats_type = 'GROUP'
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_constraint('groups_chat_id_fkey', 'groups', type_='foreignkey')
+    op.drop_index(op.f('ix_groups_chat_id'), table_name='groups')
+    op.drop_column('groups', 'chat_id')
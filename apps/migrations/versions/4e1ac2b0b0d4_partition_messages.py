@@ -0,0 +1,121 @@
+"""partition messages
+
+Revision ID: 4e1ac2b0b0d4
+Revises: f8bff7a4faad
+Create Date: 2026-10-18 20:00:00.000000
+
+"""
+from datetime import date
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = '4e1ac2b0b0d4'
+down_revision: Union[str, None] = 'f8bff7a4faad'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Секции создаются от первого месяца с сообщениями до текущего и ещё на
+# столько же месяцев вперёд, сколько создаёт приложение по умолчанию
+MONTHS_AHEAD = 3
+
+INDEXES = ('ix_messages_chat_id_id', 'ix_messages_chat_id_timestamp_id', 'ix_messages_search_vector')
+
+
+def add_months(month: date, months: int) -> date:
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.execute("ALTER TABLE messages RENAME TO messages_unpartitioned")
+    op.execute("ALTER TABLE messages_unpartitioned RENAME CONSTRAINT messages_pkey TO messages_unpartitioned_pkey")
+    op.execute("ALTER SEQUENCE messages_id_seq OWNED BY NONE")
+    for index in INDEXES + ('ix_messages_id',):
+        op.drop_index(index, table_name='messages_unpartitioned')
+
+    op.create_table('messages',
+    sa.Column('id', sa.Integer(), server_default=sa.text("nextval('messages_id_seq')"), nullable=False),
+    sa.Column('chat_id', sa.Integer(), nullable=True),
+    sa.Column('sender_id', sa.Integer(), nullable=True),
+    sa.Column('text', sa.Text(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.Column('search_vector', postgresql.TSVECTOR(), sa.Computed("to_tsvector('simple', text)", persisted=True), nullable=True),
+    sa.ForeignKeyConstraint(['chat_id'], ['chats.id'], name='messages_chat_id_fkey', ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['sender_id'], ['users.id'], name='messages_sender_id_fkey', ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id', 'timestamp'),
+    postgresql_partition_by='RANGE (timestamp)'
+    )
+    op.execute("ALTER SEQUENCE messages_id_seq OWNED BY messages.id")
+
+    first = op.get_bind().execute(sa.text("SELECT min(timestamp) FROM messages_unpartitioned")).scalar()
+    current = date.today().replace(day=1)
+    month = date(first.year, first.month, 1) if first else current
+    while month <= add_months(current, MONTHS_AHEAD):
+        op.execute(
+            f"CREATE TABLE messages_p{month.year:04d}_{month.month:02d} PARTITION OF messages "
+            f"FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}')"
+        )
+        month = add_months(month, 1)
+    op.execute("CREATE TABLE messages_default PARTITION OF messages DEFAULT")
+
+    op.execute("""
+        INSERT INTO messages (id, chat_id, sender_id, text, timestamp)
+        SELECT id, chat_id, sender_id, text, coalesce(timestamp, now() AT TIME ZONE 'utc')
+        FROM messages_unpartitioned
+    """)
+    op.drop_table('messages_unpartitioned')
+
+    op.create_index('ix_messages_chat_id_id', 'messages', ['chat_id', 'id'], unique=False)
+    op.create_index('ix_messages_chat_id_timestamp_id', 'messages', ['chat_id', 'timestamp', 'id'], unique=False)
+    op.create_index('ix_messages_search_vector', 'messages', ['search_vector'], unique=False, postgresql_using='gin')
+
+    op.create_table('message_archives',
+    sa.Column('partition', sa.String(length=63), nullable=False),
+    sa.Column('range_start', sa.DateTime(), nullable=False),
+    sa.Column('range_end', sa.DateTime(), nullable=False),
+    sa.Column('chat_ids', postgresql.ARRAY(sa.Integer()), nullable=False),
+    sa.Column('rows', sa.Integer(), nullable=False),
+    sa.Column('archived_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('partition')
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    # Уже выгруженные в архив сообщения в таблицу не возвращаются
+    op.drop_table('message_archives')
+
+    op.execute("ALTER TABLE messages RENAME TO messages_partitioned")
+    op.execute("ALTER TABLE messages_partitioned RENAME CONSTRAINT messages_pkey TO messages_partitioned_pkey")
+    op.execute("ALTER SEQUENCE messages_id_seq OWNED BY NONE")
+    for index in INDEXES:
+        op.drop_index(index, table_name='messages_partitioned')
+
+    op.create_table('messages',
+    sa.Column('id', sa.Integer(), server_default=sa.text("nextval('messages_id_seq')"), nullable=False),
+    sa.Column('chat_id', sa.Integer(), nullable=True),
+    sa.Column('sender_id', sa.Integer(), nullable=True),
+    sa.Column('text', sa.Text(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.Column('search_vector', postgresql.TSVECTOR(), sa.Computed("to_tsvector('simple', text)", persisted=True), nullable=True),
+    sa.ForeignKeyConstraint(['chat_id'], ['chats.id'], name='messages_chat_id_fkey', ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['sender_id'], ['users.id'], name='messages_sender_id_fkey', ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.execute("ALTER SEQUENCE messages_id_seq OWNED BY messages.id")
+    op.execute("""
+        INSERT INTO messages (id, chat_id, sender_id, text, timestamp)
+        SELECT id, chat_id, sender_id, text, timestamp FROM messages_partitioned
+    """)
+    op.execute("DROP TABLE messages_partitioned CASCADE")
+
+    op.create_index(op.f('ix_messages_id'), 'messages', ['id'], unique=False)
+    op.create_index('ix_messages_chat_id_id', 'messages', ['chat_id', 'id'], unique=False)
+    op.create_index('ix_messages_chat_id_timestamp_id', 'messages', ['chat_id', 'timestamp', 'id'], unique=False)
+    op.create_index('ix_messages_search_vector', 'messages', ['search_vector'], unique=False, postgresql_using='gin')
@@ -0,0 +1,59 @@
+"""chat read cursors
+
+Revision ID: 781078298e6e
+Revises: 3ffee949d7f2
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '781078298e6e'
+down_revision: Union[str, None] = '3ffee949d7f2'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('chat_reads',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('chat_id', sa.Integer(), nullable=False),
+    sa.Column('last_read_message_id', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['chat_id'], ['chats.id'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('user_id', 'chat_id')
+    )
+    op.create_index('ix_messages_chat_id_id', 'messages', ['chat_id', 'id'], unique=False)
+
+    # Общий флаг is_read переносим в курсоры: чат считается прочитанным
+    # до последнего сообщения, помеченного прочитанным
+    op.execute("""
+        INSERT INTO chat_reads (user_id, chat_id, last_read_message_id, updated_at)
+        SELECT cu.user_id, cu.chat_id, max(m.id), now()
+        FROM chat_user cu
+        JOIN messages m ON m.chat_id = cu.chat_id AND m.is_read
+        GROUP BY cu.user_id, cu.chat_id
+        ON CONFLICT DO NOTHING
+    """)
+    op.drop_column('messages', 'is_read')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.add_column('messages', sa.Column('is_read', sa.Boolean(), nullable=True))
+    op.execute("""
+        UPDATE messages SET is_read = EXISTS (
+            SELECT 1 FROM chat_reads r
+            WHERE r.chat_id = messages.chat_id
+              AND r.user_id != messages.sender_id
+              AND r.last_read_message_id >= messages.id
+        )
+    """)
+    op.drop_index('ix_messages_chat_id_id', table_name='messages')
+    op.drop_table('chat_reads')
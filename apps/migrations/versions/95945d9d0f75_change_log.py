@@ -0,0 +1,45 @@
+"""change log
+
+Revision ID: 95945d9d0f75
+Revises: 33c19abcacc8
+Create Date: 2026-10-18 22:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '95945d9d0f75'
+down_revision: Union[str, None] = '33c19abcacc8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table('change_log',
+    sa.Column('id', sa.BigInteger(), nullable=False),
+    sa.Column('txid', sa.BigInteger(), server_default=sa.text('pg_current_xact_id()::text::bigint'), nullable=False),
+    sa.Column('chat_id', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.String(length=16), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('message_id', sa.Integer(), nullable=True),
+    sa.Column('message_at', sa.DateTime(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['chat_id'], ['chats.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_change_log_chat_id_txid_id', 'change_log', ['chat_id', 'txid', 'id'], unique=False)
+    op.create_index('ix_change_log_user_id_txid_id', 'change_log', ['user_id', 'txid', 'id'], unique=False, postgresql_where=sa.text('user_id IS NOT NULL'))
+    op.create_index('ix_change_log_created_at', 'change_log', ['created_at'], unique=False, postgresql_using='brin')
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_change_log_created_at', table_name='change_log', postgresql_using='brin')
+    op.drop_index('ix_change_log_user_id_txid_id', table_name='change_log', postgresql_where=sa.text('user_id IS NOT NULL'))
+    op.drop_index('ix_change_log_chat_id_txid_id', table_name='change_log')
+    op.drop_table('change_log')
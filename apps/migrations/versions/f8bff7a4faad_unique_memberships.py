@@ -0,0 +1,49 @@
+"""unique memberships
+
+Revision ID: f8bff7a4faad
+Revises: b382e5119bbe
+Create Date: 2026-10-18 19:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f8bff7a4faad'
+down_revision: Union[str, None] = 'b382e5119bbe'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Повторные записи участников оставляем по одной
+    op.execute("""
+        DELETE FROM chat_user a USING chat_user b
+        WHERE a.chat_id = b.chat_id AND a.user_id = b.user_id AND a.id > b.id
+    """)
+    op.execute("""
+        DELETE FROM group_user a USING group_user b
+        WHERE a.group_id = b.group_id AND a.user_id = b.user_id AND a.id > b.id
+    """)
+    op.create_index('uq_chat_user_chat_id_user_id', 'chat_user', ['chat_id', 'user_id'], unique=True)
+    op.create_index('uq_group_user_group_id_user_id', 'group_user', ['group_id', 'user_id'], unique=True)
+
+    # Добавленные в группу по одному раньше не попадали в её чат
+    op.execute("""
+        INSERT INTO chat_user (chat_id, user_id)
+        SELECT g.chat_id, gu.user_id
+        FROM group_user gu
+        JOIN groups g ON g.id = gu.group_id
+        WHERE g.chat_id IS NOT NULL
+        ON CONFLICT DO NOTHING
+    """)
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('uq_group_user_group_id_user_id', table_name='group_user')
+    op.drop_index('uq_chat_user_chat_id_user_id', table_name='chat_user')
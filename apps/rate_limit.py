@@ -0,0 +1,136 @@
+import time
+
+from fastapi import HTTPException, Request
+from sqlalchemy import text
+
+from apps.cache import TTLCache
+from apps.database import db_session
+from apps.metrics import Counter
+from apps.settings import settings
+from apps.users.auth_jwt import decode_token
+
+
+rate_limited = Counter("rate_limited_total", "Requests rejected by the rate limiter", ("scope",))
+
+
+# Token bucket: в корзине до burst токенов, они восполняются со скоростью
+# rate в секунду, каждое действие забирает один токен. Корзина, которую
+# не трогали дольше RATE_LIMIT_TTL, считается полной, поэтому хранятся
+# только недавно активные ключи, не больше RATE_LIMIT_CACHE_SIZE
+class MemoryStore:
+    def __init__(self):
+        self._buckets = TTLCache(maxsize=settings.RATE_LIMIT_CACHE_SIZE, ttl=settings.RATE_LIMIT_TTL)
+
+    async def take(self, key: str, rate: float, burst: int) -> bool:
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated_at) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets.set(key, (tokens, now))
+        return allowed
+
+
+# Общие корзины для всех worker'ов в таблице rate_limits: пополнение и
+# списание выполняются одним upsert, строка корзины блокируется на время запроса.
+# Чтобы не ходить в базу на каждое действие, перед общей корзиной стоит
+# корзина worker'а: если лимит исчерпан уже в одном worker'е, он исчерпан и
+# в общей. Из общей корзины токены берутся сразу пачкой до RATE_LIMIT_LEASE
+# и тратятся локально, а после отказа базы ключ отклоняется без запросов,
+# пока в общей корзине не появится токен (1 / rate секунд). Поэтому суммарно
+# лимит может быть превышен не больше чем на RATE_LIMIT_LEASE на worker
+class PostgresStore:
+    TAKE = text("""
+        INSERT INTO rate_limits AS b (key, tokens, updated_at)
+        VALUES (:key, CAST(:burst AS integer) - CAST(:n AS integer), clock_timestamp() AT TIME ZONE 'utc')
+        ON CONFLICT (key) DO UPDATE SET
+            tokens = LEAST(:burst, b.tokens + EXTRACT(EPOCH FROM excluded.updated_at - b.updated_at) * :rate) - :n,
+            updated_at = excluded.updated_at
+        WHERE LEAST(:burst, b.tokens + EXTRACT(EPOCH FROM excluded.updated_at - b.updated_at) * :rate) >= :n
+        RETURNING tokens
+    """)
+    CLEANUP = text("DELETE FROM rate_limits WHERE updated_at < (now() AT TIME ZONE 'utc') - make_interval(secs => :ttl)")
+
+    def __init__(self):
+        self._last_cleanup = time.monotonic()
+        self._local = MemoryStore()
+        # key -> (токены, взятые из общей корзины, время, до которого ключ отклоняется)
+        self._leases = TTLCache(maxsize=settings.RATE_LIMIT_CACHE_SIZE, ttl=settings.RATE_LIMIT_TTL)
+
+    async def take(self, key: str, rate: float, burst: int) -> bool:
+        if not await self._local.take(key, rate, burst):
+            return False
+
+        now = time.monotonic()
+        tokens, denied_until = self._leases.get(key, (0, 0.0))
+        if tokens >= 1:
+            self._leases.set(key, (tokens - 1, 0.0))
+            return True
+        if now < denied_until:
+            return False
+
+        lease = max(1, min(settings.RATE_LIMIT_LEASE, burst))
+        if await self._take_shared(key, rate, burst, lease):
+            self._leases.set(key, (lease - 1, 0.0))
+            return True
+        if lease > 1 and await self._take_shared(key, rate, burst, 1):
+            self._leases.set(key, (0, 0.0))
+            return True
+        self._leases.set(key, (0, now + 1 / rate))
+        return False
+
+    async def _take_shared(self, key: str, rate: float, burst: int, n: int) -> bool:
+        async with db_session() as db:
+            result = await db.execute(self.TAKE, {"key": key, "rate": rate, "burst": burst, "n": n})
+            allowed = result.first() is not None
+            if time.monotonic() - self._last_cleanup > settings.RATE_LIMIT_TTL:
+                self._last_cleanup = time.monotonic()
+                await db.execute(self.CLEANUP, {"ttl": settings.RATE_LIMIT_TTL})
+            await db.commit()
+        return allowed
+
+
+class RateLimiter:
+    def __init__(self, store):
+        self._store = store
+
+    async def hit(self, scope: str, key, rate: float, burst: int) -> bool:
+        if rate <= 0:
+            return True
+        allowed = await self._store.take(f"{scope}:{key}", rate, burst)
+        if not allowed:
+            rate_limited.inc(scope=scope)
+        return allowed
+
+
+def get_store():
+    if settings.RATE_LIMIT_BACKEND == "postgres":
+        return PostgresStore()
+    if settings.RATE_LIMIT_BACKEND == "memory":
+        return MemoryStore()
+    raise ValueError(f"Unknown rate limit backend: {settings.RATE_LIMIT_BACKEND}")
+
+
+limiter = RateLimiter(get_store())
+
+
+# Зависимость для REST: корзина на пользователя из токена, а для запросов
+# без токена - на IP-адрес
+async def rate_limit_api(request: Request):
+    key = f"ip:{request.client.host}"
+    auth = request.headers.get("Authorization")
+    if auth and auth.startswith("Bearer "):
+        payload = await decode_token(auth.split(" ")[1])
+        if payload and "sub" in payload:
+            key = f"user:{payload.get('uid', payload['sub'])}"
+
+    if not await limiter.hit("api", key, settings.API_RATE, settings.API_BURST):
+        raise HTTPException(status_code=429, detail="Too many requests")
+
+
+# Вход и регистрация ограничиваются отдельно по IP: это защищает и от
+# перебора паролей, и от очереди к bcrypt
+async def rate_limit_auth(request: Request):
+    if not await limiter.hit("auth", request.client.host, settings.AUTH_RATE, settings.AUTH_BURST):
+        raise HTTPException(status_code=429, detail="Too many requests")
@@ -0,0 +1,116 @@
+import json
+import zlib
+from datetime import date, datetime
+
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# JSON для ответов API и кадров WebSocket: orjson, если установлен,
+# иначе стандартный json с тем же форматом дат
+def _default(obj):
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+if orjson is not None:
+    def dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+
+    def loads(data):
+        return orjson.loads(data)
+
+    class FastJSONResponse(JSONResponse):
+        def render(self, content) -> bytes:
+            return orjson.dumps(content)
+else:
+    def dumps(obj) -> str:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=_default)
+
+    def loads(data):
+        return json.loads(data)
+
+    class FastJSONResponse(JSONResponse):
+        def render(self, content) -> bytes:
+            return dumps(content).encode()
+
+
+# Двоичные кадры WebSocket: MessagePack, в котором известные ключи заменены
+# номерами из FIELD_TAGS (тот же список в static/protocol.js, порядок менять
+# нельзя, только дописывать в конец). Первый байт кадра - 0 для MessagePack
+# как есть и 1 для сжатого zlib; сжимаются кадры от WS_COMPRESS_MIN_BYTES
+FIELD_TAGS = (
+    "type", "room", "chat_id", "id", "sender_id", "text", "timestamp", "seq",
+    "messages", "has_more", "before", "message", "users", "user_id", "online",
+    "last_seen", "typing", "reset", "count", "access_token",
+)
+_TAG = {name: tag for tag, name in enumerate(FIELD_TAGS)}
+
+FRAME_RAW = b"\x00"
+FRAME_DEFLATE = b"\x01"
+
+
+def _tag(obj):
+    if isinstance(obj, dict):
+        return {_TAG.get(key, key): _tag(value) for key, value in obj.items()}
+    if isinstance(obj, list):
+        return [_tag(value) for value in obj]
+    return obj
+
+
+def _untag(obj):
+    if isinstance(obj, dict):
+        return {
+            FIELD_TAGS[key] if isinstance(key, int) and key < len(FIELD_TAGS) else key: _untag(value)
+            for key, value in obj.items()
+        }
+    if isinstance(obj, list):
+        return [_untag(value) for value in obj]
+    return obj
+
+
+def pack_frame(obj, compress_min_bytes: int = 0) -> bytes:
+    data = msgpack.packb(_tag(obj), default=_default)
+    if compress_min_bytes and len(data) >= compress_min_bytes:
+        return FRAME_DEFLATE + zlib.compress(data)
+    return FRAME_RAW + data
+
+
+class FrameError(ValueError):
+    pass
+
+
+# Сжатые кадры шлёт только сервер: от клиента они не принимаются
+# (compressed=False), иначе небольшой кадр распаковывался бы в гигабайты
+def unpack_frame(frame: bytes, compressed: bool = True):
+    data = frame[1:]
+    if frame[:1] == FRAME_DEFLATE:
+        if not compressed:
+            raise FrameError("Compressed frames are not accepted")
+        try:
+            data = zlib.decompress(data)
+        except zlib.error:
+            raise FrameError("Invalid compressed frame")
+    elif frame[:1] != FRAME_RAW:
+        raise FrameError("Unknown binary frame format")
+    try:
+        return _untag(msgpack.unpackb(data, strict_map_key=False))
+    except (ValueError, TypeError, msgpack.UnpackException):
+        raise FrameError("Invalid binary frame")
+
+
+def loads_frame(data: str):
+    try:
+        return loads(data)
+    except ValueError:
+        raise FrameError("Invalid JSON frame")
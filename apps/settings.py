@@ -14,9 +14,112 @@ class Settings(BaseSettings):
     SECRET_KEY: str
     HASH: str
 
+    # Пул соединений с базой
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    DB_POOL_TIMEOUT: float = 30
+    DB_POOL_RECYCLE: int = 1800
+    DB_POOL_PRE_PING: bool = True
+
+    # memory - один процесс, postgres - LISTEN/NOTIFY между worker'ами
+    BROADCAST_BACKEND: str = "memory"
+    BROADCAST_POOL_SIZE: int = 4
+    # Как часто проверяется соединение LISTEN (секунды)
+    BROADCAST_CHECK_INTERVAL: float = 5
+    MESSAGE_MAX_BYTES: int = 4000
+
+    # Исходящая очередь каждого сокета и политика для медленных клиентов:
+    # drop_oldest, drop_new или disconnect
+    WS_SEND_QUEUE_SIZE: int = 256
+    WS_SEND_TIMEOUT: float = 10
+    WS_SLOW_CONSUMER_POLICY: str = "drop_oldest"
+    # Сколько комнат можно слушать через одно соединение /ws
+    WS_MAX_SUBSCRIPTIONS: int = 100
+    # Ping после WS_PING_INTERVAL секунд тишины от клиента, закрытие сокета,
+    # если ответа нет WS_PING_TIMEOUT секунд (0 - без ping)
+    WS_PING_INTERVAL: float = 30
+    WS_PING_TIMEOUT: float = 10
+    # Двоичные кадры (подпротокол chat.msgpack) от этого размера в байтах
+    # сжимаются zlib один раз на кадр, а не в каждом сокете, как
+    # permessage-deflate (0 - не сжимать)
+    WS_COMPRESS_MIN_BYTES: int = 1024
+
+    # Статусы онлайн/набирает текст рассылаются в комнату не чаще раза в
+    # PRESENCE_FLUSH_INTERVAL секунд; "набирает" гаснет через PRESENCE_TYPING_TTL
+    PRESENCE_FLUSH_INTERVAL: float = 1
+    PRESENCE_TYPING_TTL: float = 5
+    PRESENCE_QUERY_MAX: int = 500
+
+    # История при подключении: последние N сообщений, отправляемые частями
+    HISTORY_INITIAL_LIMIT: int = 50
+    HISTORY_PAGE_LIMIT: int = 100
+    HISTORY_CHUNK_SIZE: int = 20
+    # Последние RECENT_MESSAGES_PER_CHAT сообщений каждого чата хранятся в
+    # памяти, всего не больше RECENT_MESSAGES_MAX_BYTES (примерно), холодные
+    # чаты вытесняются. Из них отдаются история и переподключение с since_seq
+    RECENT_MESSAGES_PER_CHAT: int = 200
+    RECENT_MESSAGES_MAX_BYTES: int = 64 * 1024 * 1024
+    # Буфер чата сверяется с chats.last_seq не чаще раза в столько секунд
+    RECENT_MESSAGES_CHECK_INTERVAL: float = 5
+    # При пропуске больше RESUME_MAX_GAP вместо пропущенного отдаётся обычная история
+    RESUME_MAX_GAP: int = 1000
+
+    # Пакетная запись сообщений: размер пачки, максимальная задержка перед
+    # записью и synchronous_commit для транзакции пачки (on - сообщение на диске
+    # до рассылки, off - быстрее, но при падении Postgres теряются последние
+    # подтверждённые сообщения)
+    INGEST_BATCH_SIZE: int = 100
+    INGEST_MAX_DELAY_MS: float = 5
+    INGEST_QUEUE_SIZE: int = 10000
+    INGEST_SYNCHRONOUS_COMMIT: str = "on"
+
+    # Сообщения секционированы по месяцам: секции создаются на
+    # MESSAGE_PARTITIONS_AHEAD месяцев вперёд, а секции старше
+    # MESSAGE_RETENTION_DAYS дней выгружаются в MESSAGE_ARCHIVE_DIR
+    # (0 - хранить всё в базе)
+    MESSAGE_PARTITIONS_AHEAD: int = 3
+    MESSAGE_RETENTION_DAYS: int = 0
+    MESSAGE_ARCHIVE_DIR: str = "archive"
+    # Сколько разобранных файлов архива (чат за месяц) держать в памяти
+    ARCHIVE_CACHE_FILES: int = 64
+    MESSAGE_MAINTENANCE_INTERVAL: float = 3600
+    # Журнал изменений для /api/sync хранится столько дней (0 - без очистки),
+    # более старые токены синхронизации получают 410
+    SYNC_RETENTION_DAYS: int = 30
+
+    USER_CACHE_SIZE: int = 10000
+    USER_CACHE_TTL: float = 60
+
+    MEMBERSHIP_CACHE_SIZE: int = 10000
+    MEMBERSHIP_CACHE_TTL: float = 60
+    # Сколько пользователей можно добавить или удалить одним запросом
+    MEMBERSHIP_BULK_MAX: int = 10000
+
+    # Ограничение частоты (token bucket): rate - действий в секунду,
+    # burst - запас для коротких всплесков, rate 0 отключает ограничение.
+    # memory - корзины в каждом worker'е, postgres - общие в таблице rate_limits
+    RATE_LIMIT_BACKEND: str = "memory"
+    RATE_LIMIT_CACHE_SIZE: int = 100000
+    RATE_LIMIT_TTL: float = 600
+    # postgres: сколько токенов worker забирает из общей корзины за один запрос
+    RATE_LIMIT_LEASE: int = 5
+    # Кадры одного пользователя по всем сокетам и сообщения в одну комнату
+    WS_USER_RATE: float = 10
+    WS_USER_BURST: int = 30
+    WS_ROOM_RATE: float = 100
+    WS_ROOM_BURST: int = 300
+    API_RATE: float = 20
+    API_BURST: int = 60
+    AUTH_RATE: float = 0.5
+    AUTH_BURST: int = 10
+
     @property
     def DATABASE_URL_asyncpg(self):
         return f'postgresql+asyncpg://{self.DB_USER}:{self.DB_PASS}@{self.DB_HOST}:{self.DB_PORT}/{self.DB_NAME}'
+
+    @property
+    def DATABASE_DSN(self):
+        return f'postgresql://{self.DB_USER}:{self.DB_PASS}@{self.DB_HOST}:{self.DB_PORT}/{self.DB_NAME}'
     
 
     model_config = SettingsConfigDict(env_file=".env")
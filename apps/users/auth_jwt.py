@@ -1,8 +1,12 @@
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from jose import jwt, JWTError
 from passlib.context import CryptContext
 from dotenv import load_dotenv
+from apps.metrics import Counter, Gauge, Histogram
+import asyncio
 import os
+import time
 
 
 load_dotenv()
@@ -13,15 +17,70 @@ HASH = os.getenv("HASH")
 
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Стоимость bcrypt. Хеши с другим числом раундов пересчитываются при входе
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+# bcrypt выполняется в отдельном пуле потоков, чтобы не блокировать event loop;
+# сверх BCRYPT_MAX_WAITING ожидающих задач новые запросы отклоняются
+BCRYPT_WORKERS = int(os.getenv("BCRYPT_WORKERS", 4))
+BCRYPT_MAX_WAITING = int(os.getenv("BCRYPT_MAX_WAITING", 64))
+
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__rounds=BCRYPT_ROUNDS,
+    bcrypt__min_rounds=BCRYPT_ROUNDS,
+    bcrypt__max_rounds=BCRYPT_ROUNDS,
+)
+
+bcrypt_executor = ThreadPoolExecutor(max_workers=BCRYPT_WORKERS, thread_name_prefix="bcrypt")
+
+bcrypt_pending = Gauge("bcrypt_pending", "Password hashing jobs running or waiting in the pool")
+bcrypt_rejected = Counter("bcrypt_rejected_total", "Password hashing jobs rejected because the pool was full")
+bcrypt_wait = Histogram("bcrypt_wait_seconds", "Time a password hashing job waited for a worker")
+bcrypt_duration = Histogram("bcrypt_duration_seconds", "Time spent hashing or verifying a password", ("operation",))
+
+_pending = 0
+
+
+class PasswordHasherBusy(Exception):
+    pass
+
+
+async def _run_bcrypt(operation: str, func, *args):
+    global _pending
+    if _pending >= BCRYPT_WORKERS + BCRYPT_MAX_WAITING:
+        bcrypt_rejected.inc()
+        raise PasswordHasherBusy()
+
+    def job():
+        started = time.perf_counter()
+        return func(*args), started, time.perf_counter()
+
+    _pending += 1
+    bcrypt_pending.set(_pending)
+    queued = time.perf_counter()
+    try:
+        result, started, finished = await asyncio.get_running_loop().run_in_executor(bcrypt_executor, job)
+    finally:
+        _pending -= 1
+        bcrypt_pending.set(_pending)
+
+    bcrypt_wait.observe(started - queued)
+    bcrypt_duration.observe(finished - started, operation=operation)
+    return result
 
 
 async def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+    return await _run_bcrypt("hash", pwd_context.hash, password)
 
 
 async def verify_password(plain: str, hashed: str) -> bool:
-    return pwd_context.verify(plain, hashed)
+    return await _run_bcrypt("verify", pwd_context.verify, plain, hashed)
+
+
+# Возвращает (совпал ли пароль, новый хеш или None, если пересчёт не нужен)
+async def verify_and_update_password(plain: str, hashed: str) -> tuple[bool, str]:
+    return await _run_bcrypt("verify", pwd_context.verify_and_update, plain, hashed)
 
 
 async def create_token(data: dict, expires_delta: timedelta = None) -> str:
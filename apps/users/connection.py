@@ -0,0 +1,185 @@
+import asyncio
+import logging
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+from apps.metrics import Counter, Gauge
+from apps.serialization import FrameError, dumps, loads, loads_frame, msgpack, pack_frame, unpack_frame
+from apps.settings import settings
+
+logger = logging.getLogger(__name__)
+
+ws_connections = Gauge("ws_connections", "Open WebSocket connections")
+ws_send_queue_depth = Gauge("ws_send_queue_depth", "Frames waiting in outbound queues of all sockets")
+ws_dropped = Counter("ws_dropped_total", "Frames dropped or sockets closed because a client was too slow", ("policy",))
+ws_send_failed = Counter("ws_send_failed_total", "Sockets closed because a send failed")
+ws_reaped = Counter("ws_reaped_total", "Sockets closed because the client did not answer a ping")
+
+ws_binary_frames = Counter("ws_binary_frames_total", "Broadcast frames converted to the binary protocol")
+
+_open: set = set()
+ws_send_queue_depth.set_function(lambda: sum(conn.queue.qsize() for conn in _open))
+
+# Подпротоколы WebSocket: клиент перечисляет поддерживаемые, сервер выбирает
+# двоичный, если установлен msgpack. Без подпротокола - JSON, как раньше
+BINARY_SUBPROTOCOL = "chat.msgpack"
+JSON_SUBPROTOCOL = "chat.json"
+
+
+async def accept(websocket: WebSocket) -> bool:
+    offered = websocket.scope.get("subprotocols", [])
+    if msgpack is not None and BINARY_SUBPROTOCOL in offered:
+        await websocket.accept(subprotocol=BINARY_SUBPROTOCOL)
+        return True
+    await websocket.accept(subprotocol=JSON_SUBPROTOCOL if JSON_SUBPROTOCOL in offered else None)
+    return False
+
+
+# Кадр рассылки приходит JSON-строкой и один и тот же объект по очереди
+# отдаётся всем подписчикам комнаты, поэтому двоичный вид последнего кадра
+# запоминается и считается один раз на всю комнату
+_last_frame = (None, None)
+
+
+def to_binary(data: str) -> bytes:
+    global _last_frame
+    if _last_frame[0] is not data:
+        ws_binary_frames.inc()
+        _last_frame = (data, pack_frame(loads(data), settings.WS_COMPRESS_MIN_BYTES))
+    return _last_frame[1]
+
+
+# Исходящая очередь сокета: рассылка только кладёт готовый кадр в очередь,
+# а отправкой занимается отдельная задача, поэтому медленный клиент
+# не задерживает остальных участников комнаты
+class Connection:
+    def __init__(self, websocket: WebSocket, binary: bool = False):
+        self.websocket = websocket
+        self.binary = binary
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=settings.WS_SEND_QUEUE_SIZE)
+        self.closed = False
+        self._writer = None
+        self._closing = None
+
+    def start(self):
+        self._writer = asyncio.create_task(self._write())
+        _open.add(self)
+        ws_connections.set(len(_open))
+
+    async def send(self, data: str):
+        if self.closed:
+            return
+        if self.binary:
+            data = to_binary(data)
+        try:
+            self.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            self._overflow(data)
+
+    # Ответы самому клиенту ждут места в очереди вместо сброса
+    async def send_text(self, data):
+        if self.closed:
+            return
+        try:
+            await asyncio.wait_for(self.queue.put(data), settings.WS_SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            await self.close(code=1013, reason="Client is too slow")
+
+    async def send_json(self, message):
+        if self.binary:
+            await self.send_text(pack_frame(message, settings.WS_COMPRESS_MIN_BYTES))
+        else:
+            await self.send_text(dumps(message))
+
+    # Сервер шлёт ping, если клиент молчит WS_PING_INTERVAL секунд, и закрывает
+    # сокет, если за WS_PING_TIMEOUT не пришло ни одного кадра: полуоткрытое
+    # соединение иначе висело бы в комнатах до первой ошибки записи.
+    # Кадры ping/pong обрабатываются здесь и обработчикам не передаются
+    async def receive_json(self):
+        while True:
+            try:
+                data = await self._receive()
+            except FrameError as e:
+                await self.send_json({"type": "error", "message": str(e)})
+                continue
+            if not isinstance(data, dict):
+                await self.send_json({"type": "error", "message": "Frame must be an object"})
+                continue
+            frame_type = data.get("type")
+            if frame_type == "ping":
+                await self.send_json({"type": "pong"})
+            elif frame_type != "pong":
+                return data
+
+    async def _receive(self):
+        # Сокет уже закрыт со стороны сервера, например после ошибки записи
+        if self.closed:
+            raise WebSocketDisconnect(code=1006)
+        if settings.WS_PING_INTERVAL <= 0:
+            return await self._read()
+        try:
+            async with asyncio.timeout(settings.WS_PING_INTERVAL):
+                return await self._read()
+        except TimeoutError:
+            pass
+        await self.send_json({"type": "ping"})
+        try:
+            async with asyncio.timeout(settings.WS_PING_TIMEOUT):
+                return await self._read()
+        except TimeoutError:
+            ws_reaped.inc()
+            await self.close(code=1001, reason="Ping timeout")
+            raise WebSocketDisconnect(code=1001)
+
+    # Клиент может слать и текстовые JSON-кадры, и двоичные, но не сжатые.
+    # Нечитаемый кадр отклоняется ошибкой, сокет остаётся открытым
+    async def _read(self):
+        message = await self.websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+        if message.get("bytes") is not None:
+            if msgpack is None:
+                raise FrameError("Binary frames are not supported")
+            return unpack_frame(message["bytes"], compressed=False)
+        return loads_frame(message["text"])
+
+    async def close(self, code: int = 1000, reason: str = ""):
+        if self.closed:
+            return
+        self.closed = True
+        _open.discard(self)
+        ws_connections.set(len(_open))
+        if self._writer and self._writer is not asyncio.current_task():
+            self._writer.cancel()
+        try:
+            await self.websocket.close(code=code, reason=reason)
+        except Exception:
+            pass
+
+    def _overflow(self, data):
+        policy = settings.WS_SLOW_CONSUMER_POLICY
+        ws_dropped.inc(policy=policy)
+        if policy == "drop_oldest":
+            self.queue.get_nowait()
+            self.queue.put_nowait(data)
+        elif policy == "drop_new":
+            return
+        elif policy == "disconnect":
+            self._closing = asyncio.create_task(self.close(code=1013, reason="Client is too slow"))
+        else:
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+
+    async def _write(self):
+        try:
+            while True:
+                data = await self.queue.get()
+                if isinstance(data, bytes):
+                    await asyncio.wait_for(self.websocket.send_bytes(data), settings.WS_SEND_TIMEOUT)
+                else:
+                    await asyncio.wait_for(self.websocket.send_text(data), settings.WS_SEND_TIMEOUT)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            ws_send_failed.inc()
+            logger.info("Send failed: %r", e)
+            await self.close(code=1011, reason="Send failed")
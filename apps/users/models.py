@@ -1,8 +1,9 @@
 import email
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, DateTime, Boolean, Text
+from sqlalchemy import Column, Integer, BigInteger, String, Float, ForeignKey, DateTime, Boolean, Text, Index, Computed, Sequence, text
+from sqlalchemy.dialects.postgresql import ARRAY, TSVECTOR
 from datetime import datetime
 from sqlalchemy import Enum as SAEnum
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, deferred
 import enum
 
 from sqlalchemy.ext.declarative import declarative_base
@@ -46,41 +47,115 @@ class Users(Base):
 
 class Chats(Base):
     __tablename__ = 'chats'
+    __table_args__ = (
+        Index("uq_chats_private_pair", "min_user_id", "max_user_id", unique=True),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String(255), index=True,unique=True)
     chats_type = Column(SAEnum(ChatType, name="chattype"), nullable=False, index=True)
+    # Упорядоченная пара участников личного чата, у групповых чатов пустая
+    min_user_id = Column(Integer, nullable=True)
+    max_user_id = Column(Integer, nullable=True)
+    # Последнее сообщение чата, обновляется при записи пачки сообщений
+    last_message_id = Column(Integer, nullable=True)
+    last_message_at = Column(DateTime, nullable=True)
+    # Последний выданный порядковый номер сообщения в чате
+    last_seq = Column(Integer, nullable=False, default=0, server_default="0")
 
     messages = relationship("Messages", back_populates="chat", cascade="all, delete-orphan")
     participants = relationship("Users", secondary="chat_user", back_populates="chats")
 
 class ChatUser(Base):
     __tablename__ = "chat_user"
+    __table_args__ = (
+        Index("uq_chat_user_chat_id_user_id", "chat_id", "user_id", unique=True),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     chat_id = Column(Integer, ForeignKey("chats.id", ondelete="CASCADE"))
-    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), index=True)
 
 
+# Таблица секционирована по месяцам timestamp (messages_pYYYY_MM), поэтому
+# timestamp входит в первичный ключ. Секции создаёт apps/chats/partitions.py
 class Messages(Base):
     __tablename__ = 'messages'
-
-    id = Column(Integer, primary_key=True, index=True)
+    __table_args__ = (
+        Index("ix_messages_chat_id_timestamp_id", "chat_id", "timestamp", "id"),
+        Index("ix_messages_chat_id_id", "chat_id", "id"),
+        Index("ix_messages_chat_id_seq", "chat_id", "seq"),
+        Index("ix_messages_search_vector", "search_vector", postgresql_using="gin"),
+        {"postgresql_partition_by": "RANGE (timestamp)"},
+    )
+
+    id = Column(Integer, Sequence("messages_id_seq"), primary_key=True)
     chat_id = Column(Integer, ForeignKey("chats.id", ondelete="CASCADE"))
     sender_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
     text = Column(Text, nullable=False)
-    timestamp = Column(DateTime, default=datetime.utcnow)
-    is_read = Column(Boolean, default=False)
+    timestamp = Column(DateTime, primary_key=True, default=datetime.utcnow)
+    # Номер сообщения внутри чата без пропусков: 1, 2, 3...
+    seq = Column(Integer, nullable=False)
+    # Поисковый вектор считает сама база; конфигурация simple без стемминга,
+    # так как сообщения пишутся на разных языках
+    search_vector = deferred(Column(TSVECTOR, Computed("to_tsvector('simple', text)", persisted=True)))
 
     chat = relationship("Chats", back_populates="messages")
     sender = relationship("Users", back_populates="messages")
 
+
+# Выгруженные в архив секции сообщений: диапазон дат и чаты, у которых
+# в этой секции были сообщения
+class MessageArchive(Base):
+    __tablename__ = 'message_archives'
+
+    partition = Column(String(63), primary_key=True)
+    range_start = Column(DateTime, nullable=False)
+    range_end = Column(DateTime, nullable=False)
+    chat_ids = Column(ARRAY(Integer), nullable=False)
+    rows = Column(Integer, nullable=False)
+    archived_at = Column(DateTime, default=datetime.utcnow)
+
+
+# Журнал изменений для /api/sync: новые сообщения, добавление и удаление
+# участников, отметки о прочтении. Пишется в той же транзакции, что и само
+# изменение. txid - номер транзакции записи: порядок журнала (txid, id)
+# не даёт курсору перескочить строки транзакций, закоммиченных позже
+class ChangeLog(Base):
+    __tablename__ = 'change_log'
+    __table_args__ = (
+        Index("ix_change_log_chat_id_txid_id", "chat_id", "txid", "id"),
+        Index("ix_change_log_user_id_txid_id", "user_id", "txid", "id", postgresql_where=text("user_id IS NOT NULL")),
+        Index("ix_change_log_created_at", "created_at", postgresql_using="brin"),
+    )
+
+    id = Column(BigInteger, primary_key=True)
+    txid = Column(BigInteger, nullable=False, server_default=text("pg_current_xact_id()::text::bigint"))
+    chat_id = Column(Integer, ForeignKey("chats.id", ondelete="CASCADE"), nullable=False)
+    kind = Column(String(16), nullable=False)
+    # Участник для member_added/member_removed, читатель для read
+    user_id = Column(Integer, nullable=True)
+    # Сообщение для message, курсор прочтения для read
+    message_id = Column(Integer, nullable=True)
+    message_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+
+class ChatRead(Base):
+    __tablename__ = 'chat_reads'
+
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    chat_id = Column(Integer, ForeignKey("chats.id", ondelete="CASCADE"), primary_key=True)
+    last_read_message_id = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
 class Groups(Base):
     __tablename__ = 'groups'
 
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String(255), index=True)
     creator_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
+    chat_id = Column(Integer, ForeignKey("chats.id", ondelete="CASCADE"), index=True)
 
     creator = relationship("Users", backref="created_groups")
     users = relationship("Users", secondary="group_user", back_populates="groups")
@@ -88,10 +163,23 @@ class Groups(Base):
 
 class GroupUser(Base):
     __tablename__ = 'group_user'
+    __table_args__ = (
+        Index("uq_group_user_group_id_user_id", "group_id", "user_id", unique=True),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     group_id = Column(Integer, ForeignKey("groups.id", ondelete="CASCADE"))
     user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"))
 
     group = relationship("Groups", overlaps="users,groups")
-    user = relationship("Users", overlaps="users,groups")
\ No newline at end of file
+    user = relationship("Users", overlaps="users,groups")
+
+# Корзины ограничителя частоты запросов для бэкенда postgres. Таблица
+# UNLOGGED: после падения базы корзины просто начинаются заново полными
+class RateLimitBucket(Base):
+    __tablename__ = 'rate_limits'
+    __table_args__ = {"prefixes": ["UNLOGGED"]}
+
+    key = Column(String(255), primary_key=True)
+    tokens = Column(Float, nullable=False)
+    updated_at = Column(DateTime, nullable=False, index=True)
@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from apps.broadcast import broadcast
+from apps.metrics import Counter, Gauge
+from apps.settings import settings
+
+logger = logging.getLogger(__name__)
+
+presence_online = Gauge("presence_online_users", "Users with at least one open socket in this worker")
+presence_frames = Counter("presence_frames_total", "Presence frames published to rooms")
+presence_updates = Counter("presence_updates_total", "Presence changes queued for fan-out")
+
+
+# Присутствие пользователей в памяти worker'а: число открытых сокетов,
+# время ухода и набор в комнатах. Изменения не рассылаются сразу, а
+# отмечаются в комнате и раз в PRESENCE_FLUSH_INTERVAL уходят одним кадром
+# на комнату с текущим состоянием, так что частые переключения одного
+# пользователя схлопываются в одно обновление
+class PresenceRegistry:
+    def __init__(self):
+        self._sockets: dict[int, int] = defaultdict(int)
+        self._last_seen: dict[int, datetime] = {}
+        self._typing: dict[tuple[str, int], float] = {}
+        self._pending: dict[str, set] = defaultdict(set)
+        self._task = None
+        presence_online.set_function(lambda: len(self._sockets))
+
+    def connect(self, user_id: int):
+        self._sockets[user_id] += 1
+
+    def disconnect(self, user_id: int, rooms):
+        self._sockets[user_id] -= 1
+        if self._sockets[user_id] > 0:
+            return
+        del self._sockets[user_id]
+        self._last_seen[user_id] = datetime.utcnow()
+        for room in rooms:
+            self._typing.pop((room, user_id), None)
+            self._mark(room, user_id)
+
+    def join(self, room: str, user_id: int):
+        self._mark(room, user_id)
+
+    def typing(self, room: str, user_id: int):
+        if (room, user_id) not in self._typing:
+            self._mark(room, user_id)
+        self._typing[(room, user_id)] = time.monotonic() + settings.PRESENCE_TYPING_TTL
+
+    def stop_typing(self, room: str, user_id: int):
+        if self._typing.pop((room, user_id), None) is not None:
+            self._mark(room, user_id)
+
+    def is_online(self, user_id: int) -> bool:
+        return user_id in self._sockets
+
+    def status(self, user_id: int) -> dict:
+        online = self.is_online(user_id)
+        last_seen = None if online else self._last_seen.get(user_id)
+        return {"user_id": user_id, "online": online, "last_seen": last_seen}
+
+    def _mark(self, room: str, user_id: int):
+        presence_updates.inc()
+        self._pending[room].add(user_id)
+
+    def _expire_typing(self):
+        now = time.monotonic()
+        expired = [key for key, deadline in self._typing.items() if deadline <= now]
+        for room, user_id in expired:
+            del self._typing[(room, user_id)]
+            self._mark(room, user_id)
+
+    async def flush(self):
+        self._expire_typing()
+        pending, self._pending = self._pending, defaultdict(set)
+        for room, user_ids in pending.items():
+            users = [
+                {**self.status(user_id), "typing": (room, user_id) in self._typing}
+                for user_id in sorted(user_ids)
+            ]
+            presence_frames.inc()
+            await broadcast.publish(room, {"type": "presence", "room": room, "users": users})
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(settings.PRESENCE_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Presence flush failed")
+
+
+presence = PresenceRegistry()
@@ -1,3 +1,5 @@
+from datetime import datetime
+from typing import Optional
 from pydantic import BaseModel
 
 
@@ -14,4 +16,10 @@ class UserSchema(BaseModel):
 
 class UserLoginSchema(BaseModel):
     username: str
-    password: str
\ No newline at end of file
+    password: str
+
+
+class PresenceSchema(BaseModel):
+    user_id: int
+    online: bool
+    last_seen: Optional[datetime] = None
@@ -0,0 +1,44 @@
+from sqlalchemy import event, inspect, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from apps.cache import TTLCache
+from apps.settings import settings
+from apps.users.models import Users
+
+
+# Аутентифицированные пользователи по subject токена, чтобы не искать
+# пользователя в базе на каждый запрос и каждое подключение сокета
+user_cache = TTLCache(maxsize=settings.USER_CACHE_SIZE, ttl=settings.USER_CACHE_TTL)
+
+
+async def get_user_by_claims(db: AsyncSession, payload: dict) -> Users:
+    username = payload["sub"]
+    user = user_cache.get(username)
+    if user is not None:
+        return user
+
+    # Новые токены содержат id пользователя - поиск по первичному ключу
+    if "uid" in payload:
+        user = await db.get(Users, payload["uid"])
+        if user and user.username != username:
+            user = None
+    else:
+        result = await db.execute(select(Users).where(Users.username == username))
+        user = result.scalars().first()
+
+    if user:
+        db.expunge(user)
+        user_cache.set(username, user)
+    return user
+
+
+def invalidate_user(username: str):
+    user_cache.pop(username)
+
+
+@event.listens_for(Users, "after_update")
+@event.listens_for(Users, "after_delete")
+def _invalidate_on_change(mapper, connection, target):
+    # При смене username сбрасываем и запись под старым именем
+    for username in [target.username, *inspect(target).attrs.username.history.deleted]:
+        invalidate_user(username)
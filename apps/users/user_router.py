@@ -1,4 +1,5 @@
-from fastapi import APIRouter, Depends, HTTPException
+from typing import List
+from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import SQLAlchemyError
@@ -6,7 +7,11 @@ from apps.database import get_db_session
 from apps.users.models import Users, Session
 from datetime import timedelta
 from apps.users.schema import *
-from apps.users.auth_jwt import hash_password, verify_password, create_token, decode_token
+from apps.users.auth_jwt import hash_password, verify_and_update_password, create_token, decode_token, PasswordHasherBusy
+from apps.users.user_cache import get_user_by_claims
+from apps.rate_limit import rate_limit_api, rate_limit_auth
+from apps.users.presence import presence
+from apps.settings import settings
 from fastapi import Request
 
 router = APIRouter()
@@ -28,9 +33,7 @@ async def get_current_user(request: Request, db: AsyncSession = Depends(get_db_s
     if not payload or "sub" not in payload:
         raise HTTPException(status_code=401, detail="Invalid token")
 
-    user = select(Users).where(Users.username == payload["sub"])
-    result = await db.execute(user)
-    user = result.scalars().first()
+    user = await get_user_by_claims(db, payload)
 
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -38,7 +41,7 @@ async def get_current_user(request: Request, db: AsyncSession = Depends(get_db_s
     return user
 
 
-@router.post("/register", response_model=UserSchema)
+@router.post("/register", response_model=UserSchema, dependencies=[Depends(rate_limit_auth)])
 async def register(payload: UserSchema, db: AsyncSession = Depends(get_db_session)):
     try:
         user = select(Users).where(Users.username == payload.username)
@@ -48,10 +51,15 @@ async def register(payload: UserSchema, db: AsyncSession = Depends(get_db_sessio
         if existing_user:
             raise HTTPException(status_code=400, detail="Username already exists")
 
+        try:
+            password = await hash_password(payload.password)
+        except PasswordHasherBusy:
+            raise HTTPException(status_code=503, detail="Server is busy, try again later")
+
         new_user = Users(
             username=payload.username,
             email=payload.email,
-            password= await hash_password(payload.password)
+            password=password
         )
 
         db.add(new_user)
@@ -64,17 +72,29 @@ async def register(payload: UserSchema, db: AsyncSession = Depends(get_db_sessio
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@router.post("/login")
+@router.post("/login", dependencies=[Depends(rate_limit_auth)])
 async def login(payload: UserLoginSchema, request: Request, db: AsyncSession = Depends(get_db_session)):
     user = select(Users).where(Users.username == payload.username)
     result = await db.execute(user)
     user = result.scalars().first()
 
-    if not user or not await verify_password(payload.password, user.password):
+    if not user:
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
-    access_token = await create_token({"sub": user.username}, expires_delta=timedelta(days=1))
-    refresh_token = await create_token({"sub": user.username}, expires_delta=timedelta(days=30))
+    try:
+        valid, new_hash = await verify_and_update_password(payload.password, user.password)
+    except PasswordHasherBusy:
+        raise HTTPException(status_code=503, detail="Server is busy, try again later")
+
+    if not valid:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+
+    # Пароль захеширован с устаревшими параметрами - сохраняем новый хеш
+    if new_hash:
+        user.password = new_hash
+
+    access_token = await create_token({"sub": user.username, "uid": user.id}, expires_delta=timedelta(days=1))
+    refresh_token = await create_token({"sub": user.username, "uid": user.id}, expires_delta=timedelta(days=30))
 
     user_agent, ip = await extract_client_info(request)
 
@@ -93,7 +113,7 @@ async def login(payload: UserLoginSchema, request: Request, db: AsyncSession = D
     }
 
 
-@router.get("/devices")
+@router.get("/devices", dependencies=[Depends(rate_limit_api)])
 async def list_devices(current_user: Users = Depends(get_current_user), db: AsyncSession = Depends(get_db_session)):
     sessions_user = select(Session).where(Session.user_id == current_user.id, Session.is_active == True)
     result = await db.execute(sessions_user)
@@ -107,3 +127,12 @@ async def list_devices(current_user: Users = Depends(get_current_user), db: Asyn
             "created_at": s.created_at
         } for s in sessions
     ]
+
+
+# Статус по сокетам этого worker'а; вошедшие через другие worker'ы видны
+# только в кадрах presence комнат
+@router.get("/presence", response_model=List[PresenceSchema], dependencies=[Depends(rate_limit_api)])
+async def get_presence(user_ids: List[int] = Query(...), current_user: Users = Depends(get_current_user)):
+    if len(user_ids) > settings.PRESENCE_QUERY_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {settings.PRESENCE_QUERY_MAX} users per request")
+    return [presence.status(user_id) for user_id in dict.fromkeys(user_ids)]
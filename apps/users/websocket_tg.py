@@ -1,267 +1,439 @@
-from fastapi import WebSocket, WebSocketDisconnect, Depends
+import logging
+import re
+
+from fastapi import WebSocket, WebSocketDisconnect
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import select,update
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
 from apps.users.models import *
 from apps.users.auth_jwt import decode_token,create_token
 from datetime import timedelta
-from apps.database import get_db_session
-from fastapi import APIRouter
+from apps.database import db_session
+from apps.broadcast import broadcast
+from apps.metrics import Counter
+from apps.rate_limit import limiter
+from apps.users.connection import Connection, accept
+from apps.users.presence import presence
+from apps.users.user_cache import get_user_by_claims
+from apps.chats.ingest import ingest
+from apps.chats.read_state import mark_read
+from apps.chats.membership import is_chat_member, is_group_member, get_group_chat_id
+from apps.chats.history import MAX_MESSAGE_ID, MAX_SEQ, load_history_before, check_recent, history_since_seq, parse_cursor, make_cursor, serialize_message
+from apps.chats.recent import RecentMessage, recent_messages, resume_requests
+from apps.settings import settings
+from fastapi import APIRouter, Query
 
 router = APIRouter()
 
-connections: dict[int, list[WebSocket]] = {}
-user_last_message: dict[int, str] = {}
+logger = logging.getLogger(__name__)
+
+ws_disconnects = Counter("ws_disconnects_total", "WebSocket clients that disconnected", ("endpoint",))
+ws_errors = Counter("ws_errors_total", "WebSocket handlers that stopped with an error", ("endpoint",))
+
+# Номер комнаты - только ASCII-цифры; chats.id и groups.id - integer в Postgres
+ROOM_PATTERN = re.compile(r"(chat|group):([0-9]{1,10})")
+MAX_ROOM_ID = 2**31 - 1
+
+# История отдаётся окном последних сообщений, частями по HISTORY_CHUNK_SIZE;
+# более старые страницы клиент запрашивает кадром load_older
+async def send_history(conn: Connection, chat_id: int, room: str, before=None, limit: int = None):
+    limit = limit or settings.HISTORY_INITIAL_LIMIT
+    # Соединение с базой нужно только на время запроса, не на время отправки
+    async with db_session() as db:
+        messages = await load_history_before(db, chat_id, limit + 1, before=before)
+    has_more = len(messages) > limit
+    messages = messages[:limit][::-1]
+
+    chunk = settings.HISTORY_CHUNK_SIZE
+    for i in range(0, len(messages), chunk):
+        await conn.send_json({
+            "type": "history",
+            "room": room,
+            "chat_id": chat_id,
+            "messages": [serialize_message(m) for m in messages[i:i + chunk]]
+        })
+
+    await conn.send_json({
+        "type": "history_end",
+        "room": room,
+        "chat_id": chat_id,
+        "has_more": has_more,
+        "before": make_cursor(messages[0]) if messages else None
+    })
+
+
+# Переподключение с since_seq: клиент получает только пропущенные кадры
+# message и затем кадр resumed. Живые сообщения могут прийти вперемешку с
+# пропущенными, повторы клиент отбрасывает по seq. Если пропуск больше
+# RESUME_MAX_GAP или уже выгружен в архив, приходит resumed с reset и
+# обычная история
+async def send_resume(conn: Connection, chat_id: int, room: str, since_seq: int):
+    async with db_session() as db:
+        await check_recent(db, chat_id)
+    messages = recent_messages.since(chat_id, since_seq)
+    if messages is not None and len(messages) <= settings.RESUME_MAX_GAP:
+        resume_requests.inc(source="memory")
+    else:
+        async with db_session() as db:
+            result = await db.execute(history_since_seq(chat_id, since_seq, settings.RESUME_MAX_GAP + 1))
+            messages = result.all()
+        if len(messages) > settings.RESUME_MAX_GAP or (messages and messages[0].seq != since_seq + 1):
+            resume_requests.inc(source="reset")
+            await conn.send_json({"type": "resumed", "room": room, "chat_id": chat_id, "reset": True})
+            await send_history(conn, chat_id, room)
+            return
+        resume_requests.inc(source="db")
+
+    for m in messages:
+        await conn.send_json({"type": "message", "room": room, **serialize_message(m)})
+    await conn.send_json({"type": "resumed", "room": room, "chat_id": chat_id, "reset": False, "count": len(messages)})
+
+
+async def send_initial(conn: Connection, chat_id: int, room: str, since_seq: int = None):
+    if since_seq is None:
+        await send_history(conn, chat_id, room)
+    else:
+        await send_resume(conn, chat_id, room, since_seq)
 
-@router.websocket("/chats/{chat_id}")
-async def websocket_chat(chat_id: int, websocket: WebSocket, db: AsyncSession = Depends(get_db_session)):
-    await websocket.accept()
 
+# Кадры, обращающиеся к базе, расходуют общую корзину пользователя на все
+# его сокеты, сообщения - ещё и корзину комнаты
+async def allow_frame(conn: Connection, user: Users, room: str = None) -> bool:
+    allowed = await limiter.hit("ws_user", user.id, settings.WS_USER_RATE, settings.WS_USER_BURST)
+    if allowed and room is not None:
+        allowed = await limiter.hit("ws_room", room, settings.WS_ROOM_RATE, settings.WS_ROOM_BURST)
+    if not allowed:
+        await conn.send_json({"type": "error", "message": "Rate limit exceeded"})
+    return allowed
+
+
+async def load_older(conn: Connection, chat_id: int, room: str, data: dict):
+    try:
+        before = parse_cursor(data["before"])
+        limit = min(int(data.get("limit", settings.HISTORY_INITIAL_LIMIT)), settings.HISTORY_PAGE_LIMIT)
+    except (KeyError, TypeError, ValueError, OverflowError):
+        await conn.send_json({"type": "error", "message": "Invalid cursor"})
+        return
+
+    if limit < 1:
+        await conn.send_json({"type": "error", "message": "Invalid limit"})
+        return
+
+    await send_history(conn, chat_id, room, before=before, limit=limit)
+
+
+async def authenticate(websocket: WebSocket) -> Users:
+    async with db_session() as db:
+        return await _authenticate(websocket, db)
+
+
+async def _authenticate(websocket: WebSocket, db: AsyncSession) -> Users:
     access_token = websocket.query_params.get("access_token")
     refresh_token = websocket.query_params.get("refresh_token")
 
     if not access_token or not refresh_token:
         await websocket.close(code=1008, reason="Missing tokens")
-        return
+        return None
 
     payload = await decode_token(access_token)
     if not payload or "sub" not in payload:
         refresh_payload = await decode_token(refresh_token)
         if not refresh_payload or "sub" not in refresh_payload:
             await websocket.close(code=1008, reason="Invalid refresh token")
-            return
+            return None
 
         session_q = select(Session).where(Session.refresh_token == refresh_token, Session.is_active == True)
         session_result = await db.execute(session_q)
         session = session_result.scalars().first()
         if not session:
             await websocket.close(code=1008, reason="Session not found or expired")
-            return
+            return None
 
-        new_access_token = await create_token({"sub": refresh_payload["sub"]}, expires_delta=timedelta(minutes=5))
+        claims = {k: refresh_payload[k] for k in ("sub", "uid") if k in refresh_payload}
+        new_access_token = await create_token(claims, expires_delta=timedelta(minutes=5))
         payload = refresh_payload
         await websocket.send_json({"type": "new_token", "access_token": new_access_token})
 
-    user_q = select(Users).where(Users.username == payload["sub"])
-    result = await db.execute(user_q)
-    user = result.scalars().first()
+    user = await get_user_by_claims(db, payload)
     if not user:
         await websocket.close(code=1008, reason="User not found")
+        return None
+
+    return user
+
+
+# Под каноническим именем ("chat:01" -> "chat:1") комната подписывается,
+# рассылается и ограничивается по частоте, иначе у неё было бы несколько имён
+def canonical_room(room) -> str:
+    match = ROOM_PATTERN.fullmatch(str(room))
+    if match is None:
+        return str(room)
+    return f"{match[1]}:{int(match[2])}"
+
+
+# Комната "chat:<id>" или "group:<id>" -> id чата, где хранятся её сообщения,
+# или None, если комнаты нет или пользователь в ней не состоит
+async def resolve_room(room: str, user: Users) -> int:
+    match = ROOM_PATTERN.fullmatch(room)
+    if match is None:
+        return None
+    kind, room_id = match[1], int(match[2])
+    if room_id > MAX_ROOM_ID:
+        return None
+
+    async with db_session() as db:
+        if kind == "chat":
+            if await is_chat_member(db, room_id, user.id):
+                return room_id
+        elif kind == "group":
+            if await is_group_member(db, room_id, user.id):
+                return await get_group_chat_id(db, room_id)
+    return None
+
+
+async def handle_send(conn: Connection, user: Users, chat_id: int, room: str, data: dict):
+    text = str(data.get("text", "")).strip()
+
+    if not text:
+        await conn.send_json({"type": "error", "message": "Message is too short"})
         return
 
-    is_participant_q = select(ChatUser).where(ChatUser.chat_id == chat_id, ChatUser.user_id == user.id)
-    participant_result = await db.execute(is_participant_q)
-    if not participant_result.scalars().first():
-        await websocket.close(code=1008, reason="You are not in this chat")
+    if len(text.encode()) > settings.MESSAGE_MAX_BYTES:
+        await conn.send_json({"type": "error", "message": "Message is too long"})
         return
 
-    connections.setdefault(chat_id, []).append(websocket)
-    await websocket.send_text(f"Connected to chat #{chat_id} as {user.username}")
+    if not await allow_frame(conn, user, room):
+        return
 
-    history_q = select(Messages).where(Messages.chat_id == chat_id).order_by(Messages.timestamp)
-    result = await db.execute(history_q)
-    history = result.scalars().all()
-    await websocket.send_json([
-        {
-            "type": "history",
-            "id": m.id,
-            "chat_id": m.chat_id,
-            "sender_id": m.sender_id,
-            "text": m.text,
-            "timestamp": m.timestamp.isoformat(),
-            "is_read": m.is_read
-        }
-        for m in history
-    ])
+    try:
+        message = await ingest.submit(chat_id, user.id, text)
+    except SQLAlchemyError:
+        await conn.send_json({"type": "error", "message": "Message was not saved"})
+        return
 
+    # Буфер последних сообщений пополняется сразу, не дожидаясь рассылки
+    recent_messages.add(RecentMessage(*message))
+    presence.stop_typing(room, user.id)
+    # Сообщение уже сохранено: при сбое рассылки его получат из истории
     try:
+        await broadcast.publish(room, {"type": "message", "room": room, **serialize_message(message)})
+    except Exception:
+        logger.exception("Broadcast failed for %s", room)
+        await conn.send_json({"type": "error", "message": "Message was saved but not delivered"})
+
+
+async def handle_read(conn: Connection, user: Users, chat_id: int, data: dict):
+    message_id = data.get("message_id")
+    if message_id is not None and (
+        isinstance(message_id, bool) or not isinstance(message_id, int) or not 0 <= message_id <= MAX_MESSAGE_ID
+    ):
+        await conn.send_json({"type": "error", "message": "Invalid message_id"})
+        return
+    if not await allow_frame(conn, user):
+        return
+    async with db_session() as db:
+        await mark_read(db, user.id, chat_id, message_id)
+
+
+# Одно соединение на клиента: аутентификация при подключении, дальше клиент
+# подписывается на любые свои чаты и группы кадрами subscribe/unsubscribe,
+# а все кадры в обе стороны помечаются полем room
+@router.websocket("")
+async def websocket_session(websocket: WebSocket):
+    binary = await accept(websocket)
+
+    user = await authenticate(websocket)
+    if not user:
+        return
+
+    conn = Connection(websocket, binary=binary)
+    conn.start()
+    rooms: dict[str, int] = {}
+
+    presence.connect(user.id)
+    try:
+        await conn.send_json({"type": "connect", "message": f"Connected as {user.username}"})
+
         while True:
-            data = await websocket.receive_json()
+            data = await conn.receive_json()
+            frame_type = data.get("type")
+            room = canonical_room(data.get("room", ""))
 
-            if data.get("type") == "send":
-                text = data.get("text", "").strip()
+            if frame_type == "subscribe":
+                if room in rooms:
+                    await conn.send_json({"type": "subscribed", "room": room})
+                    continue
 
-                if not text:
-                    await websocket.send_json({"type": "error", "message": "Message is too short"})
+                if len(rooms) >= settings.WS_MAX_SUBSCRIPTIONS:
+                    await conn.send_json({"type": "error", "room": room, "message": "Too many subscriptions"})
                     continue
 
-                if user_last_message.get(user.id) == text:
-                    await websocket.send_json({"type": "error", "message": "Duplicate message detected"})
+                since_seq = data.get("since_seq")
+                if since_seq is not None and (
+                    isinstance(since_seq, bool) or not isinstance(since_seq, int) or not 0 <= since_seq <= MAX_SEQ
+                ):
+                    await conn.send_json({"type": "error", "room": room, "message": "Invalid since_seq"})
                     continue
 
-                user_last_message[user.id] = text
+                if not await allow_frame(conn, user):
+                    continue
 
-                message = Messages(chat_id=chat_id, sender_id=user.id, text=text)
-                db.add(message)
-                await db.commit()
-                await db.refresh(message)
+                chat_id = await resolve_room(room, user)
+                if chat_id is None:
+                    await conn.send_json({"type": "error", "room": room, "message": "You are not in this room"})
+                    continue
 
-                payload = {
-                    "type": "message",
-                    "id": message.id,
-                    "chat_id": message.chat_id,
-                    "sender_id": message.sender_id,
-                    "text": message.text,
-                    "timestamp": message.timestamp.isoformat(),
-                    "is_read": message.is_read
-                }
+                rooms[room] = chat_id
+                broadcast.subscribe(room, conn.send)
+                presence.join(room, user.id)
+                await conn.send_json({"type": "subscribed", "room": room, "chat_id": chat_id})
+                await send_initial(conn, chat_id, room, since_seq)
 
-                for ws in connections.get(chat_id, []):
-                    await ws.send_json(payload)
+            elif frame_type == "unsubscribe":
+                if rooms.pop(room, None) is not None:
+                    broadcast.unsubscribe(room, conn.send)
+                    presence.stop_typing(room, user.id)
+                await conn.send_json({"type": "unsubscribed", "room": room})
 
-            elif data.get("type") == "read":
-                await db.execute(
-                    update(Messages)
-                    .where(Messages.chat_id == chat_id, Messages.sender_id != user.id)
-                    .values(is_read=True)
-                )
-                await db.commit()
+            elif room not in rooms:
+                await conn.send_json({"type": "error", "room": room, "message": "Not subscribed to this room"})
+
+            elif frame_type == "send":
+                await handle_send(conn, user, rooms[room], room, data)
+
+            elif frame_type == "load_older":
+                if await allow_frame(conn, user):
+                    await load_older(conn, rooms[room], room, data)
+
+            elif frame_type == "read":
+                await handle_read(conn, user, rooms[room], data)
+
+            elif frame_type == "typing":
+                presence.typing(room, user.id)
 
     except WebSocketDisconnect:
-        if websocket in connections.get(chat_id, []):
-            connections[chat_id].remove(websocket)
-            if not connections[chat_id]:  
-                del connections[chat_id]
+        ws_disconnects.inc(endpoint="session")
+        logger.info("Disconnected: %s", user.username)
 
-        # Очищаем последнее сообщение пользователя
-        user_last_message.pop(user.id, None)
+    except Exception:
+        ws_errors.inc(endpoint="session")
+        logger.exception("Error in session of %s", user.username)
 
-        print(f"Disconnected: {user.username}")
+    finally:
+        for room in rooms:
+            broadcast.unsubscribe(room, conn.send)
+        presence.disconnect(user.id, rooms)
+        await conn.close()
 
-    except Exception as e:
-        print(f"Error: {e}")
 
+@router.websocket("/chats/{chat_id}")
+async def websocket_chat(chat_id: int, websocket: WebSocket, since_seq: int = Query(None, ge=0, le=MAX_SEQ)):
+    binary = await accept(websocket)
 
+    user = await authenticate(websocket)
+    if not user:
+        return
 
+    if await resolve_room(f"chat:{chat_id}", user) is None:
+        await websocket.close(code=1008, reason="You are not in this chat")
+        return
 
+    conn = Connection(websocket, binary=binary)
+    conn.start()
+    room = f"chat:{chat_id}"
+    presence.connect(user.id)
+    presence.join(room, user.id)
+    # Подписка и начальная история внутри try: обрыв или ошибка базы во
+    # время отправки истории тоже должны снять подписку и закрыть сокет
+    try:
+        broadcast.subscribe(room, conn.send)
+        await conn.send_text(f"Connected to chat #{chat_id} as {user.username}")
 
-group_connections: dict[int, list[WebSocket]] = {}
-group_last_message: dict[int, dict[int, str]] = {}  
+        await send_initial(conn, chat_id, room, since_seq)
 
-@router.websocket("/groups/{group_id}")
-async def websocket_group_chat(group_id: int, websocket: WebSocket, db: AsyncSession = Depends(get_db_session)):
-    await websocket.accept()
+        while True:
+            data = await conn.receive_json()
 
-    access_token = websocket.query_params.get("access_token")
-    refresh_token = websocket.query_params.get("refresh_token")
+            if data.get("type") == "send":
+                await handle_send(conn, user, chat_id, room, data)
 
-    if not access_token or not refresh_token:
-        await websocket.close(code=1008, reason="Missing tokens")
-        return
+            elif data.get("type") == "load_older":
+                if await allow_frame(conn, user):
+                    await load_older(conn, chat_id, room, data)
 
-    payload = await decode_token(access_token)
-    if not payload or "sub" not in payload:
-        refresh_payload = await decode_token(refresh_token)
-        if not refresh_payload or "sub" not in refresh_payload:
-            await websocket.close(code=1008, reason="Invalid refresh token")
-            return
+            elif data.get("type") == "read":
+                await handle_read(conn, user, chat_id, data)
 
-        session_q = select(Session).where(Session.refresh_token == refresh_token, Session.is_active == True)
-        session_result = await db.execute(session_q)
-        session = session_result.scalars().first()
-        if not session:
-            await websocket.close(code=1008, reason="Session not found or expired")
-            return
+            elif data.get("type") == "typing":
+                presence.typing(room, user.id)
+
+    except WebSocketDisconnect:
+        ws_disconnects.inc(endpoint="chat")
+        logger.info("Disconnected from chat %s: %s", chat_id, user.username)
+
+    except Exception:
+        ws_errors.inc(endpoint="chat")
+        logger.exception("Error in chat %s of %s", chat_id, user.username)
+
+    finally:
+        broadcast.unsubscribe(room, conn.send)
+        presence.disconnect(user.id, (room,))
+        await conn.close()
 
-        new_access_token = await create_token({"sub": refresh_payload["sub"]}, expires_delta=timedelta(minutes=5))
-        payload = refresh_payload
-        await websocket.send_json({"type": "new_token", "access_token": new_access_token})
 
-    user_q = select(Users).where(Users.username == payload["sub"])
-    result = await db.execute(user_q)
-    user = result.scalars().first()
+@router.websocket("/groups/{group_id}")
+async def websocket_group_chat(group_id: int, websocket: WebSocket, since_seq: int = Query(None, ge=0, le=MAX_SEQ)):
+    binary = await accept(websocket)
+
+    user = await authenticate(websocket)
     if not user:
-        await websocket.close(code=1008, reason="User not found")
         return
 
-    is_member_q = select(GroupUser).where(GroupUser.group_id == group_id, GroupUser.user_id == user.id)
-    member_result = await db.execute(is_member_q)
-    if not member_result.scalars().first():
+    group_chat_id = await resolve_room(f"group:{group_id}", user)
+    if group_chat_id is None:
         await websocket.close(code=1008, reason="You are not in this group")
         return
 
-    group_connections.setdefault(group_id, []).append(websocket)
-    group_last_message.setdefault(group_id, {}) 
+    conn = Connection(websocket, binary=binary)
+    conn.start()
+    room = f"group:{group_id}"
+    presence.connect(user.id)
+    presence.join(room, user.id)
+    try:
+        broadcast.subscribe(room, conn.send)
 
-    await websocket.send_json({
-        "type": "connect",
-        "message": f"Connected to group #{group_id} as {user.username}"
-    })
+        await conn.send_json({
+            "type": "connect",
+            "message": f"Connected to group #{group_id} as {user.username}"
+        })
 
-    group = select(Groups).where(Groups.id == group_id)
-    result = await db.execute(group)
-    group_ = result.scalars().first()
-    chat = select(Chats).where(Chats.title == group_.title, Chats.chats_type == ChatType.GROUP)
-    result = await db.execute(chat)
-    group_chat = result.scalars().first()
-    history_q = select(Messages).where(Messages.chat_id == group_chat.id).order_by(Messages.timestamp)
-    result = await db.execute(history_q)
-    history = result.scalars().all()
-    await websocket.send_json([
-        {
-            "type": "history",
-            "id": m.id,
-            "chat_id": m.chat_id,
-            "sender_id": m.sender_id,
-            "text": m.text,
-            "timestamp": m.timestamp.isoformat(),
-            "is_read": m.is_read
-        }
-        for m in history
-    ])
+        await send_initial(conn, group_chat_id, room, since_seq)
 
-    try:
         while True:
-            data = await websocket.receive_json()
+            data = await conn.receive_json()
 
             if data.get("type") == "send":
-                text = data.get("text", "").strip()
+                await handle_send(conn, user, group_chat_id, room, data)
 
-                if not text:
-                    await websocket.send_json({"type": "error", "message": "Message is too short"})
-                    continue
-
-                last_message = group_last_message[group_id].get(user.id)
-                if last_message == text:
-                    await websocket.send_json({"type": "error", "message": "Duplicate message detected"})
-                    continue
-
-                group_last_message[group_id][user.id] = text
-
-                message = Messages(chat_id=group_chat.id, sender_id=user.id, text=text)
-                db.add(message)
-                await db.commit()
-                await db.refresh(message)
-
-                payload = {
-                    "type": "message",
-                    "id": message.id,
-                    "chat_id": message.chat_id,
-                    "sender_id": message.sender_id,
-                    "text": message.text,
-                    "timestamp": message.timestamp.isoformat(),
-                    "is_read": message.is_read
-                }
-
-                for ws in group_connections.get(group_id, []):
-                    await ws.send_json(payload)
+            elif data.get("type") == "load_older":
+                if await allow_frame(conn, user):
+                    await load_older(conn, group_chat_id, room, data)
 
             elif data.get("type") == "read":
-                await db.execute(
-                    update(Messages)
-                    .where(Messages.chat_id == group_id, Messages.sender_id != user.id)
-                    .values(is_read=True)
-                )
-                await db.commit()
+                await handle_read(conn, user, group_chat_id, data)
 
-    except WebSocketDisconnect as e:
-        if websocket in group_connections.get(group_id, []):
-            group_connections[group_id].remove(websocket)
-        print(f"Disconnected from group {group_id}: {user.username} (code={e.code})")
+            elif data.get("type") == "typing":
+                presence.typing(room, user.id)
 
-        if not group_connections[group_id]:
-            del group_connections[group_id]
-            del group_last_message[group_id]
+    except WebSocketDisconnect as e:
+        ws_disconnects.inc(endpoint="group")
+        logger.info("Disconnected from group %s: %s (code=%s)", group_id, user.username, e.code)
 
-    except Exception as e:
-        print(f"Error in group chat: {e}")
+    except Exception:
+        ws_errors.inc(endpoint="group")
+        logger.exception("Error in group %s of %s", group_id, user.username)
 
+    finally:
+        broadcast.unsubscribe(room, conn.send)
+        presence.disconnect(user.id, (room,))
+        await conn.close()
@@ -0,0 +1,306 @@
+"""Нагрузочный тест чат-сервера.
+
+Поднимает main:app через uvicorn на локальном Postgres (параметры DB_* из .env
+или окружения, схема должна быть создана через alembic upgrade head),
+создаёт пользователей, личные чаты и группы, а затем одновременно гоняет
+WebSocket-клиентов через /ws/chats/{id} и /ws/groups/{id} и REST-запросы
+к /api/login, /api/history и /api/chats.
+
+Пример:
+    python bench/load_test.py --users 50 --clients 200 --messages 20 --workers 2
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+
+import httpx
+import websockets
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+def report_line(name: str, latencies: list[float], elapsed: float) -> str:
+    ms = [v * 1000 for v in latencies]
+    return (
+        f"{name:<22} n={len(ms):<7} "
+        f"p50={percentile(ms, 50):8.2f}ms p95={percentile(ms, 95):8.2f}ms p99={percentile(ms, 99):8.2f}ms "
+        f"mean={statistics.fmean(ms) if ms else 0:8.2f}ms rate={len(ms) / elapsed if elapsed else 0:9.1f}/s"
+    )
+
+
+def process_rss_kb(pid: int) -> int:
+    # RSS процесса uvicorn и всех его worker'ов
+    total = 0
+    pids = [pid]
+    try:
+        children = subprocess.run(["pgrep", "-P", str(pid)], capture_output=True, text=True).stdout.split()
+        pids += [int(child) for child in children]
+    except FileNotFoundError:
+        pass
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except FileNotFoundError:
+            continue
+    return total
+
+
+class Server:
+    def __init__(self, port: int, workers: int, env: dict):
+        self.port = port
+        self.workers = workers
+        self.env = env
+        self.process = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    @property
+    def ws_url(self):
+        return f"ws://127.0.0.1:{self.port}"
+
+    def start(self):
+        cmd = [
+            sys.executable, "-m", "uvicorn", "main:app",
+            "--host", "127.0.0.1", "--port", str(self.port),
+            "--workers", str(self.workers), "--log-level", "warning",
+        ]
+        self.process = subprocess.Popen(cmd, cwd=ROOT, env=self.env)
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            try:
+                httpx.get(self.base_url + "/docs", timeout=1)
+                return
+            except httpx.HTTPError:
+                time.sleep(0.2)
+        self.stop()
+        raise RuntimeError("Server did not start")
+
+    def stop(self):
+        if self.process:
+            self.process.terminate()
+            self.process.wait(timeout=30)
+
+
+async def seed(client: httpx.AsyncClient, users: int, groups: int, group_size: int):
+    tag = uuid.uuid4().hex[:8]
+    accounts = []
+    for i in range(users):
+        username = f"bench_{tag}_{i}"
+        r = await client.post("/api/register", json={"username": username, "email": f"{username}@bench", "password": "bench"})
+        r.raise_for_status()
+        user_id = r.json()["id"]
+        r = await client.post("/api/login", json={"username": username, "password": "bench"})
+        r.raise_for_status()
+        accounts.append({"id": user_id, "username": username, **r.json()})
+
+    # Личные чаты между соседними пользователями
+    chats = []
+    for i in range(0, users - 1, 2):
+        a, b = accounts[i], accounts[i + 1]
+        r = await client.post(
+            "/api/create_private_chat",
+            params={"user1_id": a["id"], "user2_id": b["id"]},
+            headers={"Authorization": f"Bearer {a['access_token']}"},
+        )
+        r.raise_for_status()
+        chats.append({"chat_id": r.json()["chat_id"], "members": [a, b]})
+
+    group_rooms = []
+    for g in range(groups):
+        members = [accounts[(g * group_size + j) % users] for j in range(group_size)]
+        creator = members[0]
+        r = await client.post(
+            "/api/groups",
+            json={"title": f"bench_{tag}_group_{g}", "creator_id": creator["id"], "user_ids": [m["id"] for m in members[1:]]},
+            headers={"Authorization": f"Bearer {creator['access_token']}"},
+        )
+        r.raise_for_status()
+        group_rooms.append({"group_id": r.json()["group_id"], "members": members})
+
+    return accounts, chats, group_rooms
+
+
+async def ws_client(server: Server, path: str, account: dict, messages: int, interval: float, results: dict):
+    query = f"access_token={account['access_token']}&refresh_token={account['refresh_token']}"
+    started = time.perf_counter()
+    try:
+        async with websockets.connect(f"{server.ws_url}{path}?{query}", max_queue=None) as ws:
+            # Подключение считается готовым после окончания истории
+            while True:
+                try:
+                    data = json.loads(await ws.recv())
+                except ValueError:
+                    continue
+                if isinstance(data, dict) and data.get("type") == "history_end":
+                    break
+            results["connect"].append(time.perf_counter() - started)
+
+            pending = {}
+
+            async def reader():
+                while pending or not sending_done.is_set():
+                    try:
+                        data = json.loads(await ws.recv())
+                    except ValueError:
+                        continue
+                    if not isinstance(data, dict):
+                        continue
+                    if data.get("type") == "ping":
+                        await ws.send(json.dumps({"type": "pong"}))
+                    elif data.get("type") == "message" and data.get("text") in pending:
+                        results["fanout"].append(time.perf_counter() - pending.pop(data["text"]))
+                    elif data.get("type") == "error":
+                        results["errors"] += 1
+
+            sending_done = asyncio.Event()
+            reader_task = asyncio.create_task(reader())
+            for n in range(messages):
+                text = f"{account['username']} {n} {uuid.uuid4().hex[:6]}"
+                pending[text] = time.perf_counter()
+                await ws.send(json.dumps({"type": "send", "text": text}))
+                if interval:
+                    await asyncio.sleep(interval)
+            sending_done.set()
+            try:
+                await asyncio.wait_for(reader_task, timeout=30)
+            except asyncio.TimeoutError:
+                results["lost"] += len(pending)
+                reader_task.cancel()
+    except Exception as e:
+        results["failed"] += 1
+        print(f"client {account['username']} failed: {e}", file=sys.stderr)
+
+
+async def rest_client(client: httpx.AsyncClient, account: dict, chat_id: int, logins: list, requests: int, results: dict):
+    headers = {"Authorization": f"Bearer {account['access_token']}"}
+    for n in range(requests):
+        kind = ("history", "chats", "login")[n % 3]
+        started = time.perf_counter()
+        try:
+            if kind == "history":
+                r = await client.get(f"/api/history/{chat_id}", params={"limit": 100}, headers=headers)
+            elif kind == "chats":
+                r = await client.get("/api/chats", headers=headers)
+            else:
+                # Логины идут по кругу по всем пользователям: токены с одинаковым
+                # sub и exp совпадают, если один пользователь входит дважды за секунду
+                login = logins.pop(0)
+                logins.append(login)
+                r = await client.post("/api/login", json={"username": login["username"], "password": "bench"})
+        except httpx.HTTPError:
+            results["rest_errors"] += 1
+            continue
+        elapsed = time.perf_counter() - started
+        if r.status_code >= 400:
+            results["rest_errors"] += 1
+        results[f"rest_{kind}"].append(elapsed)
+
+
+async def run(args, server: Server):
+    limits = httpx.Limits(max_connections=args.rest_concurrency * 2)
+    async with httpx.AsyncClient(base_url=server.base_url, timeout=60, limits=limits) as client:
+        print(f"Seeding {args.users} users, {args.groups} groups ...")
+        accounts, chats, groups = await seed(client, args.users, args.groups, args.group_size)
+
+        results = {
+            "connect": [], "fanout": [], "errors": 0, "failed": 0, "lost": 0, "rest_errors": 0,
+            "rest_history": [], "rest_chats": [], "rest_login": [],
+        }
+
+        tasks = []
+        for i in range(args.clients):
+            # Клиенты поровну распределяются между личными чатами и группами
+            if groups and (i % 2 or not chats):
+                room = groups[i % len(groups)]
+                path = f"/ws/groups/{room['group_id']}"
+            else:
+                room = chats[i % len(chats)]
+                path = f"/ws/chats/{room['chat_id']}"
+            account = room["members"][(i // 2) % len(room["members"])]
+            tasks.append(ws_client(server, path, account, args.messages, args.interval, results))
+
+        logins = list(accounts)
+        for i in range(args.rest_concurrency):
+            room = chats[i % len(chats)]
+            tasks.append(rest_client(client, room["members"][0], room["chat_id"], logins, args.rest_requests, results))
+
+        rss_before = process_rss_kb(server.process.pid)
+        started = time.perf_counter()
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+        rss_after = process_rss_kb(server.process.pid)
+
+    lines = [
+        f"clients={args.clients} messages/client={args.messages} workers={args.workers} elapsed={elapsed:.2f}s",
+        report_line("ws connect+history", results["connect"], elapsed),
+        report_line("ws send->receive", results["fanout"], elapsed),
+        report_line("GET /api/history", results["rest_history"], elapsed),
+        report_line("GET /api/chats", results["rest_chats"], elapsed),
+        report_line("POST /api/login", results["rest_login"], elapsed),
+        f"ws errors={results['errors']} failed clients={results['failed']} lost messages={results['lost']} "
+        f"rest errors={results['rest_errors']}",
+        f"server RSS before={rss_before / 1024:.1f}MB after={rss_after / 1024:.1f}MB",
+    ]
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for the chat server")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--groups", type=int, default=4)
+    parser.add_argument("--group-size", type=int, default=10)
+    parser.add_argument("--clients", type=int, default=50, help="concurrent WebSocket clients")
+    parser.add_argument("--messages", type=int, default=20, help="messages sent by each client")
+    parser.add_argument("--interval", type=float, default=0.0, help="pause between messages of one client, seconds")
+    parser.add_argument("--rest-concurrency", type=int, default=10)
+    parser.add_argument("--rest-requests", type=int, default=30, help="requests per REST client")
+    parser.add_argument("--port", type=int, default=8077)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--bcrypt-rounds", type=int, default=4, help="bcrypt cost used by the server under test")
+    parser.add_argument("--output", help="also write the report to this file")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env["BCRYPT_ROUNDS"] = str(args.bcrypt_rounds)
+    # Ограничение частоты отключено, если не задано явно: тест меряет сервер,
+    # а не срабатывание лимитов
+    for name in ("WS_USER_RATE", "WS_ROOM_RATE", "API_RATE", "AUTH_RATE"):
+        env.setdefault(name, "0")
+    if args.workers > 1:
+        env.setdefault("BROADCAST_BACKEND", "postgres")
+
+    server = Server(args.port, args.workers, env)
+    server.start()
+    try:
+        report = asyncio.run(run(args, server))
+    finally:
+        server.stop()
+
+    print(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+"""Замер сериализации страницы истории без сервера и базы.
+
+Сравнивает путь, которым /api/history и кадры history отдают сообщения
+(serialize_message + dumps), со стандартным json.
+
+Пример:
+    python bench/serialization.py --page 100 --rounds 2000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from apps.chats.history import serialize_message, encode_cursor  # noqa: E402
+from apps.serialization import dumps  # noqa: E402
+
+
+Row = namedtuple("Row", ["id", "chat_id", "sender_id", "text", "timestamp"])
+
+
+def make_page(size: int) -> list:
+    now = datetime.utcnow()
+    return [Row(i, 1, i % 7, f"message number {i} " * 4, now - timedelta(seconds=i)) for i in range(size)]
+
+
+def measure(name: str, func, rounds: int, page: int):
+    func()
+    started = time.perf_counter()
+    for _ in range(rounds):
+        func()
+    elapsed = time.perf_counter() - started
+    print(f"{name:<16} {elapsed / rounds * 1e6:9.1f}us/page {rounds * page / elapsed:12.0f} messages/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="History page serialization benchmark")
+    parser.add_argument("--page", type=int, default=100, help="messages per page")
+    parser.add_argument("--rounds", type=int, default=2000)
+    args = parser.parse_args()
+
+    rows = make_page(args.page)
+
+    def fast():
+        return dumps({"messages": [serialize_message(r) for r in rows], "next_cursor": encode_cursor(rows[-1])})
+
+    def stdlib():
+        return json.dumps(
+            {"messages": [serialize_message(r) for r in rows], "next_cursor": encode_cursor(rows[-1])},
+            default=lambda o: o.isoformat(),
+        )
+
+    measure("dumps", fast, args.rounds, args.page)
+    measure("json.dumps", stdlib, args.rounds, args.page)
+
+
+if __name__ == "__main__":
+    main()
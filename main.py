@@ -1,11 +1,35 @@
 
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 from apps.users import user_router,websocket_tg
 from apps.chats import chat_router
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
+from apps.broadcast import broadcast
+from apps.chats.ingest import ingest
+from apps.chats.archive import archiver
+from apps.users.presence import presence
+from apps.serialization import FastJSONResponse
+from apps.metrics import RequestMetricsMiddleware, render
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await broadcast.connect()
+    await ingest.start()
+    await archiver.start()
+    await presence.start()
+    yield
+    await presence.stop()
+    await archiver.stop()
+    await ingest.stop()
+    await broadcast.disconnect()
+
+
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
+
+app.add_middleware(RequestMetricsMiddleware)
 
 
 app.add_middleware(
@@ -21,4 +45,12 @@ app.add_middleware(
 app.include_router(user_router.router, prefix="/api", tags=['users'])
 app.include_router(chat_router.router, prefix="/api", tags=['chats'])
 app.include_router(websocket_tg.router, prefix="/ws", tags=['users_socket'])
+
+
+# Метрики считаются в каждом worker'е отдельно
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
+
+
 app.mount("/static", StaticFiles(directory="static", html=True), name="static")
\ No newline at end of file
@@ -0,0 +1,110 @@
+// Двоичные кадры WebSocket (подпротокол chat.msgpack): первый байт - 0 для
+// MessagePack как есть и 1 для сжатого zlib, ключи заменены номерами из
+// FIELD_TAGS. Список должен совпадать с FIELD_TAGS в apps/serialization.py
+const FIELD_TAGS = [
+    "type", "room", "chat_id", "id", "sender_id", "text", "timestamp", "seq",
+    "messages", "has_more", "before", "message", "users", "user_id", "online",
+    "last_seen", "typing", "reset", "count", "access_token",
+];
+
+const SUBPROTOCOLS = ["chat.msgpack", "chat.json"];
+
+const textDecoder = new TextDecoder();
+
+function unpack(bytes) {
+    const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+    let pos = 0;
+
+    function str(length) {
+        const value = textDecoder.decode(bytes.subarray(pos, pos + length));
+        pos += length;
+        return value;
+    }
+
+    function bin(length) {
+        const value = bytes.slice(pos, pos + length);
+        pos += length;
+        return value;
+    }
+
+    function array(length) {
+        const value = [];
+        for (let i = 0; i < length; i++) {
+            value.push(read());
+        }
+        return value;
+    }
+
+    function map(length) {
+        const value = {};
+        for (let i = 0; i < length; i++) {
+            const key = read();
+            value[typeof key === "number" && key < FIELD_TAGS.length ? FIELD_TAGS[key] : key] = read();
+        }
+        return value;
+    }
+
+    function read() {
+        const byte = bytes[pos++];
+        let value;
+        if (byte <= 0x7f) return byte;
+        if (byte >= 0xe0) return byte - 0x100;
+        if (byte >= 0x80 && byte <= 0x8f) return map(byte & 0x0f);
+        if (byte >= 0x90 && byte <= 0x9f) return array(byte & 0x0f);
+        if (byte >= 0xa0 && byte <= 0xbf) return str(byte & 0x1f);
+        switch (byte) {
+            case 0xc0: return null;
+            case 0xc2: return false;
+            case 0xc3: return true;
+            case 0xc4: value = view.getUint8(pos); pos += 1; return bin(value);
+            case 0xc5: value = view.getUint16(pos); pos += 2; return bin(value);
+            case 0xc6: value = view.getUint32(pos); pos += 4; return bin(value);
+            case 0xca: value = view.getFloat32(pos); pos += 4; return value;
+            case 0xcb: value = view.getFloat64(pos); pos += 8; return value;
+            case 0xcc: value = view.getUint8(pos); pos += 1; return value;
+            case 0xcd: value = view.getUint16(pos); pos += 2; return value;
+            case 0xce: value = view.getUint32(pos); pos += 4; return value;
+            case 0xcf: value = Number(view.getBigUint64(pos)); pos += 8; return value;
+            case 0xd0: value = view.getInt8(pos); pos += 1; return value;
+            case 0xd1: value = view.getInt16(pos); pos += 2; return value;
+            case 0xd2: value = view.getInt32(pos); pos += 4; return value;
+            case 0xd3: value = Number(view.getBigInt64(pos)); pos += 8; return value;
+            case 0xd9: value = view.getUint8(pos); pos += 1; return str(value);
+            case 0xda: value = view.getUint16(pos); pos += 2; return str(value);
+            case 0xdb: value = view.getUint32(pos); pos += 4; return str(value);
+            case 0xdc: value = view.getUint16(pos); pos += 2; return array(value);
+            case 0xdd: value = view.getUint32(pos); pos += 4; return array(value);
+            case 0xde: value = view.getUint16(pos); pos += 2; return map(value);
+            case 0xdf: value = view.getUint32(pos); pos += 4; return map(value);
+        }
+        throw new Error(`Unsupported MessagePack type 0x${byte.toString(16)}`);
+    }
+
+    return read();
+}
+
+async function inflate(bytes) {
+    const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream("deflate"));
+    return new Uint8Array(await new Response(stream).arrayBuffer());
+}
+
+// Текстовые кадры - JSON, двоичные - MessagePack
+async function decodeFrame(data) {
+    if (typeof data === "string") {
+        return JSON.parse(data);
+    }
+    const bytes = new Uint8Array(data);
+    if (bytes[0] === 1) {
+        return unpack(await inflate(bytes.subarray(1)));
+    }
+    if (bytes[0] === 0) {
+        return unpack(bytes.subarray(1));
+    }
+    throw new Error("Unknown binary frame format");
+}
+
+function openChatSocket(url) {
+    const socket = new WebSocket(url, SUBPROTOCOLS);
+    socket.binaryType = "arraybuffer";
+    return socket;
+}